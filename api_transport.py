@@ -0,0 +1,106 @@
+"""HTTP-транспорт клиентов весов к серверу администрирования.
+
+Одна keep-alive сессия requests на процесс вместо отдельного соединения на
+каждый запрос: цикл "команда - результат - подтверждение" идет по уже
+открытому TCP/TLS соединению. Обрывы соединения повторяются с нарастающей
+паузой, крупные тела запросов можно сжимать gzip (сервер распаковывает их
+сам, см. GzipRequestMiddleware в server.py).
+"""
+import gzip
+import json
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+REQUEST_TIMEOUT = 10  # Таймаут запроса к серверу (секунды)
+POOL_CONNECTIONS = 1  # Сервер один - один пул
+POOL_MAXSIZE = 4  # Опрос команд, статус по таймеру и отправка результатов идут параллельно
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.5  # Паузы между повторами: 0.5, 1, 2 секунды
+RETRY_STATUSES = (502, 503, 504)
+GZIP_MIN_SIZE = 1024  # Тела меньше этого размера не сжимаются
+
+
+class ApiTransport:
+    def __init__(self, server_url: str, client_id: str, gzip_requests: bool = False):
+        self.server_url = server_url.rstrip('/')
+        self.client_id = client_id
+        self.gzip_requests = gzip_requests
+        self.session = requests.Session()
+        # Обрыв соединения повторяется для любых запросов - запрос до сервера не дошел.
+        # Ответы 502/503/504 повторяются только для GET: POST мог быть уже обработан
+        retry = Retry(
+            total=RETRY_TOTAL,
+            connect=RETRY_TOTAL,
+            read=0,
+            status=RETRY_TOTAL,
+            backoff_factor=RETRY_BACKOFF,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({'GET'}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, endpoint: str, client_id: str = None) -> str:
+        return f"{self.server_url}/api/{endpoint}/{client_id or self.client_id}"
+
+    def get(self, endpoint: str, params=None, timeout: float = REQUEST_TIMEOUT, client_id: str = None):
+        resp = self.session.get(self.url(endpoint, client_id), params=params, timeout=timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+    def poll_commands(self, client_ids, wait: float = 0):
+        """Одним запросом забирает ожидающие команды сразу для нескольких клиентов"""
+        params = {'clients': ','.join(client_ids), 'wait': wait}
+        resp = self.session.get(f"{self.server_url}/api/commands", params=params, timeout=REQUEST_TIMEOUT + wait)
+        resp.raise_for_status()
+        return resp.json()
+
+    def get_blob(self, digest: str, offset: int = 0):
+        """Потоковый ответ с телом команды; offset - докачка с этого байта"""
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        return self.session.get(f"{self.server_url}/api/blobs/{digest}", headers=headers, stream=True,
+                                timeout=REQUEST_TIMEOUT)
+
+    def post(self, endpoint: str, payload, timeout: float = REQUEST_TIMEOUT, client_id: str = None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.gzip_requests and len(body) >= GZIP_MIN_SIZE:
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+        resp = self.session.post(self.url(endpoint, client_id), data=body, headers=headers, timeout=timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+    def close(self):
+        self.session.close()
+        logging.info("HTTP-сессия с сервером закрыта")
+
+
+class ApiBatch:
+    """Собирает отправки одного цикла клиента в один запрос POST /api/batch.
+
+    Элементы применяются сервером по порядку одной транзакцией, поэтому
+    результат команды, выгруженные PLU и подтверждение уходят вместе.
+    """
+    def __init__(self, transport: ApiTransport, client_id: str = None):
+        self.transport = transport
+        self.client_id = client_id
+        self.items = []
+
+    def add(self, item_type: str, **payload):
+        self.items.append({'type': item_type, **payload})
+
+    def drain(self) -> list:
+        items, self.items = self.items, []
+        return items
+
+    def send(self):
+        items = self.drain()
+        if not items:
+            return None
+        return self.transport.post('batch', {'items': items}, client_id=self.client_id)
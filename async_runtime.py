@@ -0,0 +1,214 @@
+"""Среда выполнения клиента весов на asyncio.
+
+Опрос команд, выполнение команд на весах, опрос статуса, вывод на дисплей
+и отправка очереди на сервер идут отдельными задачами и не ждут друг
+друга: зависший запрос к серверу не задерживает обмен с весами, а долгая
+выгрузка PLU не задерживает получение следующей команды - полученные
+команды ждут в очереди и выполняются по порядку.
+
+Блокирующие вызовы (requests, pyserial, sqlite) выполняются в пуле из
+нескольких постоянных потоков-демонов (DaemonExecutor), длинный опрос
+команд - в своем пуле из одного потока, чтобы не занимать общий.
+Незавершенный длинный опрос или выгрузка PLU не держат выход из
+программы. Асинхронного HTTP-клиента в зависимостях клиента нет, поэтому
+запросы идут через тот же ApiTransport на requests.
+
+Среда работает с модулем клиента (client или casclient) и его
+ScaleClient, не меняя их: команды выполняет тот же execute_command.
+"""
+import asyncio
+import functools
+import logging
+import queue
+import threading
+from concurrent.futures import Executor, Future
+
+HEALTH_INTERVAL = 1.0  # Проверка подключения весов (секунды)
+TASK_ERROR_PAUSE = 1.0  # Пауза после ошибки в задаче (секунды)
+RUNTIME_WORKERS = 6  # Потоков для блокирующих вызовов одних весов: команда, статус, дисплей, очередь...
+
+
+class DaemonExecutor(Executor):
+    """Пул из не более max_workers постоянных потоков-демонов.
+
+    Потоки создаются по мере надобности и переиспользуются. В отличие от
+    ThreadPoolExecutor, выход из программы не ждет их завершения.
+    """
+    def __init__(self, max_workers: int, name: str):
+        self._max_workers = max_workers
+        self._name = name
+        self._queue = queue.SimpleQueue()
+        self._idle = threading.Semaphore(0)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Пул потоков остановлен')
+            self._queue.put((future, fn, args, kwargs))
+            if not self._idle.acquire(blocking=False) and len(self._threads) < self._max_workers:
+                thread = threading.Thread(target=self._worker, name=f'{self._name}-{len(self._threads)}',
+                                          daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        return future
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            self._idle.release()
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        item[0].cancel()
+            for _ in self._threads:
+                self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+def run_blocking(executor, fn, *args, **kwargs):
+    """Выполняет блокирующий вызов в пуле executor"""
+    return asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run_forever(name, step):
+    """Повторяет шаг задачи; ошибка шага не останавливает задачу"""
+    while True:
+        try:
+            await step()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка в задаче {name}: {e}")
+            await asyncio.sleep(TASK_ERROR_PAUSE)
+
+
+async def outbox_step(outbox, executor):
+    pause = await run_blocking(executor, outbox.flush_step)
+    await run_blocking(executor, outbox.wait, pause)
+
+
+class ClientRuntime:
+    def __init__(self, module, scale_client, status_interval: float = None):
+        self.module = module
+        self.scale_client = scale_client
+        self.status_interval = status_interval
+        self._scale_lock = None
+        self._status_ready = None
+        self._latest_status = None
+        self._commands = None
+        self._executor = DaemonExecutor(RUNTIME_WORKERS, 'runtime')
+        self._poll_executor = DaemonExecutor(1, 'long-poll')
+
+    async def _scale(self, fn, *args):
+        """Обмен с весами: одна операция за раз, как в последовательном цикле"""
+        async with self._scale_lock:
+            return await run_blocking(self._executor, fn, *args)
+
+    async def _health_step(self):
+        if not self.scale_client.is_ready():
+            await self._scale(self.scale_client.try_reconnect)
+            await run_blocking(self._executor, self.module.send_status, self.scale_client)
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def _poll_step(self):
+        module = self.module
+        cmd_resp = await run_blocking(self._poll_executor, module.get_command, module.LONG_POLL_TIMEOUT)
+        if cmd_resp and cmd_resp.get('command'):
+            # Команды выполняет своя задача, опрос сразу ждет следующую
+            self._commands.put_nowait(cmd_resp)
+        elif not cmd_resp or 'wait' not in cmd_resp:
+            # Сервер недоступен или не умеет ждать команду - обычный опрос
+            await asyncio.sleep(module.POLL_INTERVAL)
+
+    async def _commands_step(self):
+        module = self.module
+        cmd_resp = await self._commands.get()
+        command = cmd_resp['command']
+        command_id = cmd_resp['command_id']
+
+        logging.info(f"Получена команда: {command}")
+        # Все, что команда отправляет на сервер, уходит одним запросом
+        batch = module.ApiBatch(module.api)
+        result = await self._scale(module.execute_command, command, self.scale_client, batch)
+
+        module.send_data('command_result', result, batch)
+        module.ack_command(command_id, result, batch)
+        await run_blocking(self._executor, module.send_batch, batch)
+
+        logging.info(f"Команда выполнена: {result}")
+
+    async def _status_step(self):
+        # poll_status ставит чтение в очередь порта весов и не создает второго запроса,
+        # пока не выполнен предыдущий
+        status = await asyncio.wrap_future(self.scale_client.poll_status())
+        if status:
+            self._latest_status = status
+            self._status_ready.set()
+        await asyncio.sleep(self.status_interval)
+
+    async def _weighings_step(self):
+        # Взвешивания копятся в ScaleClient и уходят пачкой, см. weighing.py
+        await asyncio.sleep(HEALTH_INTERVAL)
+        if self.scale_client.weighings.due():
+            await run_blocking(self._executor, self.module.send_weighings, self.scale_client)
+
+    async def _display_step(self):
+        # На дисплей выводится последний статус, промежуточные пропускаются
+        await self._status_ready.wait()
+        self._status_ready.clear()
+        await run_blocking(self._executor, self.scale_client.show_status, self._latest_status)
+
+    async def _outbox_step(self):
+        await outbox_step(self.module.outbox, self._executor)
+
+    async def run(self):
+        self._scale_lock = asyncio.Lock()
+        self._status_ready = asyncio.Event()
+        self._commands = asyncio.Queue()
+        steps = {
+            'health': self._health_step,
+            'poll': self._poll_step,
+            'commands': self._commands_step,
+            'outbox': self._outbox_step,
+        }
+        if self.status_interval:
+            # Дисплей обновляет своя задача, чтение статуса не ждет порт дисплея
+            self.scale_client.display_on_read = False
+            steps['status'] = self._status_step
+            steps['display'] = self._display_step
+            if hasattr(self.scale_client, 'weighings'):
+                steps['weighings'] = self._weighings_step
+
+        await run_blocking(self._executor, self.module.send_status, self.scale_client)
+        tasks = [asyncio.create_task(run_forever(name, step), name=name) for name, step in steps.items()]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.module.outbox.stop()
+            # Потоки-демоны не держат выход; вызовы, еще не начатые, отменяются
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._poll_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,64 @@
+"""Микро-замер scale_codec: записей в секунду при сборке и разборе.
+
+    python bench_codec.py --records 10000
+"""
+import argparse
+import time
+
+import scale_codec
+
+
+def _plu(number):
+    return {
+        'id': number,
+        'name1': f'Товар {number}',
+        'name2': 'Тестовый',
+        'price': 10050 + number,
+        'code': f'{number % 1000000:06d}',
+        'group_code': '000001',
+        'tare': 0,
+        'message_number': 0,
+        'expiry_type': 0,
+        'expiry_value': '01.01.26',
+        'logo_type': 0,
+        'cert_code': '',
+    }
+
+
+def _rate(fn, count, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замер скорости scale_codec')
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    count = args.records
+    plu_list = [_plu(n) for n in range(1, count + 1)]
+    # Ответы на чтение PLU: запись + 17 байт итогов, уложенные подряд
+    tail = bytes.fromhex('000000010126') + bytes(11)
+    read_buffer = b''.join(scale_codec.encode_plu(plu) + tail for plu in plu_list)
+    status_frame = scale_codec.encode_status({'status_byte': 0x40, 'weight': 1250, 'price': 10050,
+                                              'sum': 12562, 'plu_number': 1})
+
+    cases = {
+        'encode_plu': lambda: [scale_codec.encode_plu(plu) for plu in plu_list],
+        'encode_plus (batch)': lambda: scale_codec.encode_plus(plu_list),
+        'decode_plu': lambda: [scale_codec.decode_plu(read_buffer, i * scale_codec.PLU_READ.size)
+                               for i in range(count)],
+        'decode_plus (batch)': lambda: scale_codec.decode_plus(read_buffer),
+        'decode_status': lambda: [scale_codec.decode_status(status_frame) for _ in range(count)],
+    }
+    for name, fn in cases.items():
+        print(f"{name:22} {_rate(fn, count, args.repeat):12,.0f} записей/с")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""Нагрузочные замеры обмена ScaleClient с весами.
+
+По умолчанию весы подменяются имитатором scale_sim.py, через --port можно
+указать настоящие весы или внешний имитатор. Результаты пишутся в JSON,
+чтобы сравнивать версии между собой (--compare).
+
+    python bench_serial.py --wire-speed --sizes 100,1000 --output bench_results.json
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime
+
+from scale_sim import ScaleSimulator
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    if len(samples) > 1:
+        cuts = statistics.quantiles(samples, n=100, method='inclusive')
+        p50, p90, p99 = cuts[49], cuts[89], cuts[98]
+    else:
+        p50 = p90 = p99 = samples[0]
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p50_ms': p50 * 1000,
+        'p90_ms': p90 * 1000,
+        'p99_ms': p99 * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def _timed(fn, iterations):
+    samples = []
+    failures = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+        if not result:
+            failures += 1
+    stats = _percentiles(samples)
+    stats['failures'] = failures
+    return stats
+
+
+def _make_plu(number):
+    return {
+        'number': number,
+        'name1': f'Товар {number}',
+        'name2': 'Тестовый',
+        'price': 100 + number % 900 + 0.5,
+        'code': f'{number % 1000000:06d}',
+        'group_code': '000001',
+        'tare': 0,
+        'message_number': 0,
+        'expiry_type': 1,
+        'expiry_value': '30',
+        'logo_type': 0,
+        'cert_code': '',
+    }
+
+
+def _scale_plu(number):
+    plu = _make_plu(number)
+    plu['id'] = plu.pop('number')
+    plu['price'] = int(plu['price'] * 100)
+    return plu
+
+
+def _create_plu_uncached(scale_client, number):
+    scale_client.mirror.forget(number)
+    return scale_client.create_plu(_scale_plu(number))
+
+
+def bench_opcodes(scale_client, iterations):
+    scale_client.mirror.clear()
+    scale_client.create_plu(_scale_plu(1))
+    cases = {
+        'get_status': scale_client.get_current_status,
+        'get_plu': lambda: scale_client.get_plu_by_id(1),
+        'create_plu': lambda: _create_plu_uncached(scale_client, 2),
+        'get_total_sales': scale_client.get_total_sales,
+    }
+    results = {}
+    for name, fn in cases.items():
+        results[name] = _timed(fn, iterations)
+        print(f"{name}: p50 {results[name]['p50_ms']:.1f} мс, p99 {results[name]['p99_ms']:.1f} мс")
+    return results
+
+
+def bench_upload(module, scale_client, sizes):
+    results = {}
+    for size in sizes:
+        command = json.dumps({'action': 'upload_plu', 'data': [_make_plu(n) for n in range(1, size + 1)]})
+        # Первый проход пишет все записи, повторный - отвечает из копии PLU клиента
+        scale_client.mirror.clear()
+        for key in ('', 'repeat_'):
+            start = time.perf_counter()
+            result = module.execute_command(command, scale_client)
+            elapsed = time.perf_counter() - start
+            results[f'{key}{size}'] = {
+                'seconds': elapsed,
+                'records_per_s': size / elapsed if elapsed else 0.0,
+                'uploaded': result.get('uploaded_count', 0),
+            }
+            print(f"upload_plu {key}{size}: {elapsed:.2f} с, {size / elapsed if elapsed else 0.0:.1f} записей/с")
+    return results
+
+
+def bench_reconnect(scale_client, iterations):
+    def reconnect():
+        scale_client.disconnect()
+        scale_client._last_reconnect_attempt = 0
+        return scale_client.try_reconnect()
+
+    def wait_ready():
+        scale_client.ser.reset_input_buffer()
+        scale_client.ser.write(b'\x01')
+        return scale_client._wait_ready()
+
+    results = {
+        'try_reconnect': _timed(reconnect, iterations),
+        'wait_ready': _timed(wait_ready, iterations),
+    }
+    print(f"try_reconnect: p50 {results['try_reconnect']['p50_ms']:.1f} мс")
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+def _compare(baseline_path, results):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"Сравнение с {baseline_path} ({baseline.get('revision')}):")
+    for name, stats in results['opcodes'].items():
+        old = baseline.get('opcodes', {}).get(name)
+        if old:
+            print(f"  {name:16} p50 {old['p50_ms']:8.1f} -> {stats['p50_ms']:8.1f} мс")
+    for size, stats in results['upload'].items():
+        old = baseline.get('upload', {}).get(size)
+        if old:
+            print(f"  upload {size:>9} {old['records_per_s']:8.1f} -> {stats['records_per_s']:8.1f} записей/с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры обмена ScaleClient с весами')
+    parser.add_argument('--client', default='client', choices=['client', 'casclient'])
+    parser.add_argument('--port', help='порт весов; без него запускается имитатор')
+    parser.add_argument('--wire-speed', action='store_true', help='имитатор отвечает со скоростью линии')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--sizes', default='100,1000,10000', help='размеры каталогов для upload_plu')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='файл с предыдущими результатами')
+    args = parser.parse_args()
+
+    module = importlib.import_module(args.client)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    sim = None
+    port = args.port
+    if not port:
+        sim = ScaleSimulator(wire_speed=args.wire_speed, jitter=args.jitter, error_rate=args.error_rate, seed=0)
+        port = sim.start()
+
+    scale_client = module.ScaleClient(port=port)
+    try:
+        if not scale_client.is_ready():
+            raise SystemExit(f"Весы на {port} не отвечают")
+        sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+        results = {
+            'timestamp': datetime.now().isoformat(),
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'client': args.client,
+            'port': args.port or 'simulator',
+            'simulator': None if args.port else {
+                'wire_speed': args.wire_speed, 'jitter': args.jitter, 'error_rate': args.error_rate,
+            },
+            'baudrate': scale_client.baudrate,
+            'opcodes': bench_opcodes(scale_client, args.iterations),
+            'upload': bench_upload(module, scale_client, sizes),
+            'reconnect': bench_reconnect(scale_client, min(args.iterations, 10)),
+        }
+    finally:
+        scale_client.disconnect()
+        if sim:
+            sim.stop()
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+
+    if args.compare:
+        _compare(args.compare, results)
+
+if __name__ == '__main__':
+    main()
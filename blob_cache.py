@@ -0,0 +1,67 @@
+"""Кэш больших тел команд, полученных с сервера по хэшу содержимого.
+
+Сервер хранит тело большой команды (например, каталога PLU) один раз и
+присылает клиенту ссылку {'action': 'blob', 'blob': <sha256>}. Клиент
+скачивает тело через /api/blobs/<sha256>, после обрыва докачивает его
+запросом Range, проверяет хэш и хранит последние BLOB_CACHE_SIZE тел на
+диске: повторная команда с тем же содержимым не скачивается заново.
+"""
+import hashlib
+import logging
+import os
+import re
+
+BLOB_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blob_cache')
+BLOB_CACHE_SIZE = 20  # Сколько тел команд хранить
+CHUNK_SIZE = 64 * 1024
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class BlobCache:
+    def __init__(self, path: str = BLOB_CACHE_DIR):
+        self.path = path
+
+    def get(self, digest: str, transport) -> bytes:
+        if not _DIGEST_RE.match(digest or ''):
+            raise ValueError(f"Некорректный хэш тела команды: {digest!r}")
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, digest)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if hashlib.sha256(data).hexdigest() == digest:
+                os.utime(path)
+                return data
+            os.remove(path)
+
+        data = self._download(digest, transport, path + '.part')
+        os.replace(path + '.part', path)
+        self._prune()
+        return data
+
+    def _download(self, digest, transport, part_path, resume=True):
+        offset = os.path.getsize(part_path) if resume and os.path.exists(part_path) else 0
+        with transport.get_blob(digest, offset) as resp:
+            if resp.status_code == 416:
+                # Недокачанный файл не совпадает с телом на сервере - качаем заново
+                return self._download(digest, transport, part_path, resume=False)
+            resp.raise_for_status()
+            if offset and resp.status_code == 206:
+                logging.info(f"Докачка тела команды {digest[:12]} с {offset} байт")
+            mode = 'ab' if resp.status_code == 206 else 'wb'
+            with open(part_path, mode) as f:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+        with open(part_path, 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            os.remove(part_path)
+            raise ValueError(f"Хэш тела команды {digest[:12]} не совпадает")
+        return data
+
+    def _prune(self):
+        paths = [os.path.join(self.path, name) for name in os.listdir(self.path) if _DIGEST_RE.match(name)]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[BLOB_CACHE_SIZE:]:
+            os.remove(path)
@@ -1,9 +1,18 @@
+import asyncio
+import base64
+import sys
 import time
-import requests
 import json
 import logging
 import serial
 from datetime import datetime
+from api_transport import REQUEST_TIMEOUT, ApiBatch, ApiTransport
+from async_runtime import ClientRuntime
+from blob_cache import BlobCache
+from outbox import Outbox
+from plu_mirror import PLUMirror
+from scale_codec import (decode_plu, decode_plu_record, decode_status, decode_total_sales, encode_plu,
+                         iter_plu_records, scale_plu)
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -12,7 +21,9 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 SERVER_URL = 'http://localhost:5000'
 CLIENT_ID = 'scale001'
 POLL_INTERVAL = 10
+LONG_POLL_TIMEOUT = 25  # Сколько сервер держит запрос команды, если очередь пуста
 RECONNECT_INTERVAL = 30
+GZIP_REQUESTS = True  # Сжимать крупные тела запросов к серверу
 
 # Настройки весов
 SERIAL_PORT = 'COM2'
@@ -54,8 +65,27 @@ LENGTHS = {
     "plu_code": 4,
 }
 
+# Длины ответов по командам (без байта заголовка и байта готовности)
+REPLY_LENGTHS = {
+    COMMANDS["read_logo2"]: LENGTHS["logo2"],
+    COMMANDS["read_user_settings"]: LENGTHS["user_settings"],
+    COMMANDS["read_factory_settings"]: LENGTHS["factory_settings"],
+    COMMANDS["get_status"]: LENGTHS["current_status"],
+    COMMANDS["get_plu"]: LENGTHS["plu"],
+    COMMANDS["get_message"]: LENGTHS["message"],
+    COMMANDS["get_total_sales"]: LENGTHS["total_sales"],
+    COMMANDS["get_plu_by_key"]: LENGTHS["plu_code"],
+}
+
 ERROR_RESPONSE = b'\xEE'
 
+# Тайминги обмена
+SERIAL_TIMEOUT = 2          # Таймаут чтения порта по умолчанию (секунды)
+WAKE_ATTEMPTS = 3           # Попыток разбудить весы байтом 0x01
+WAKE_TIMEOUT = 0.1          # Ожидание ответа на 0x01 (секунды)
+COMMAND_DATA_DELAY = 0.05   # Пауза между кодом команды и данными (секунды)
+RESPONSE_TIMEOUT = 0.5      # Запас на обработку команды весами сверх времени передачи (секунды)
+
 class ScaleClient:
     def __init__(self, port=SERIAL_PORT, baudrate=BAUDRATE):
         self.port = port
@@ -65,6 +95,7 @@ class ScaleClient:
         self._last_reconnect_attempt = 0
         self._connection_attempts = 0
         self._max_connection_attempts = 5
+        self.mirror = PLUMirror(port)
         
         self._connect(port, baudrate)
 
@@ -80,7 +111,7 @@ class ScaleClient:
                 bytesize=8,
                 parity='N',
                 stopbits=1,
-                timeout=2,
+                timeout=SERIAL_TIMEOUT,
                 write_timeout=3
             )
             self.ser.reset_input_buffer()
@@ -90,6 +121,8 @@ class ScaleClient:
             if self._wait_ready():
                 logging.info(f"Подключение к весам установлено: {self.ser.is_open}")
                 self._connection_attempts = 0
+                # Копия PLU сверяется с весами при каждом новом подключении
+                self.mirror.check_scale(self._read_identity(), self.get_total_sales(), self._read_plu_record)
                 return True
             else:
                 logging.error("Не удалось установить связь с весами")
@@ -158,78 +191,80 @@ class ScaleClient:
         logging.info("Таймаут ожидания байта готовности")
         return False
 
+    def _wire_time(self, size: int) -> float:
+        """Время передачи size байт по линии (8N1 - 10 бит на байт)"""
+        return size * 10.0 / self.baudrate
+
+    def _read_frame(self, size: int, timeout: float) -> bytes:
+        """Читает ровно size байт одним вызовом read(n), ограниченным по времени"""
+        frame = bytearray(size)
+        self.ser.timeout = timeout
+        try:
+            received = self.ser.readinto(frame)
+        finally:
+            self.ser.timeout = SERIAL_TIMEOUT
+        return bytes(frame[:received])
+
+    def _wake(self) -> bool:
+        """Будит весы байтом 0x01 и ждет ответный байт"""
+        for _ in range(WAKE_ATTEMPTS):
+            self.ser.write(b'\x01')
+            if self._read_frame(1, WAKE_TIMEOUT):
+                return True
+        return False
+
+    def _read_ready(self):
+        ready = self._read_frame(1, self._wire_time(1) + RESPONSE_TIMEOUT)
+        if ready == b'\x80':
+            self._ready_state = True
+
     def _send_command(self, cmd: bytes, data: bytes = b'', expected_len: int = None) -> bytes:
         if not self.is_ready():
             logging.error("Весы не готовы к работе!")
             return b''
+        if expected_len is None:
+            expected_len = REPLY_LENGTHS.get(cmd, 0)
         try:
             self.ser.reset_input_buffer()
             logging.info(f"Отправка команды {cmd}, данные: {data.hex()}")
-            
-            buffer = b''
-            counter = 0
-            while self.ser.in_waiting == 0 and counter < 3:
-                try:
-                    self.ser.write(bytes.fromhex('01'))
-                except serial.SerialException as e:
-                    return None
-                time.sleep(0.05)
-                counter += 1
-
-            while self.ser.in_waiting > 0:
-                buffer += self.ser.read()
-                time.sleep(0.01)
 
-            if len(buffer) == 0:
+            try:
+                if not self._wake():
+                    return None
+                self.ser.write(cmd)
+                if data:
+                    time.sleep(COMMAND_DATA_DELAY)
+                    self.ser.write(data)
+                self.ser.flush()
+            except serial.SerialException as e:
                 return None
 
-            buffer = b''
-            
-            counter = 0
-            while self.ser.in_waiting == 0 and counter < 3:
-                try:
-                    self.ser.write(cmd)
-                    time.sleep(0.05)
-                    if data:
-                        self.ser.write(data)
-                except serial.SerialException as e:
-                    return None
-                time.sleep(0.05)
-                counter += 1
-
-            buffer = b''
-            while self.ser.in_waiting > 0:
-                buffer += self.ser.read()
-                time.sleep(0.01)
-            self.ser.flush()
-            
-            response = buffer
-            logging.info(f"{response.hex()}")
+            # Первый байт ответа: заголовок кадра или 0x80/0xEE
+            timeout = self._wire_time(len(data) + expected_len + 2) + RESPONSE_TIMEOUT
+            head = self._read_frame(1, timeout)
+            if head == b'\xEE':
+                logging.error("Ошибка выполнения команды (b'\\xEE')")
+                self._read_ready()
+                return b'\xEE'
+
             if expected_len and expected_len > 0:
-                if response and response[0:1] == b'\xEE':
-                    logging.error("Ошибка выполнения команды (b'\\xEE')")
-                    ready = self.ser.read(1)
-                    if ready == b'\x80':
-                        self._ready_state = True
-                    return b'\xEE'
-                ready = self.ser.read(1)
-                if ready == b'\x80':
+                if not head:
+                    logging.error("Нет ответа от весов")
+                    return b''
+                # Тело кадра и байт готовности читаются одним вызовом
+                frame = self._read_frame(expected_len + 1, self._wire_time(expected_len + 1) + RESPONSE_TIMEOUT)
+                response = frame[:expected_len]
+                logging.info(f"{response.hex()}")
+                if frame[expected_len:] == b'\x80':
                     self._ready_state = True
-                return response[1:]
+                return response
             else:
-                resp = response
-                if resp == b'\xEE':
-                    logging.error("Ошибка выполнения команды (b'\\xEE')")
-                    ready = self.ser.read(1)
-                    if ready == b'\x80':
-                        self._ready_state = True
-                    return b'\xEE'
-                elif resp == b'\x80':
+                if head == b'\x80':
                     self._ready_state = True
                     return b''
                 else:
                     self._ready_state = False
-                    logging.error(f"Неожиданный ответ: {resp.hex()}")
+                    logging.error(f"Неожиданный ответ: {head.hex()}")
                     return b'\xEE'
         except Exception as e:
             logging.error(f"Ошибка связи с весами: {str(e)}")
@@ -252,146 +287,54 @@ class ScaleClient:
         response = self._send_command(cmd=COMMANDS["get_plu"], data=id_bytes, expected_len=LENGTHS['plu'])
 
         if response == ERROR_RESPONSE:
+            self.mirror.forget(id)
             return {}
 
         if not self._check_response(response, LENGTHS["plu"], "PLU"):
             return {}
 
-        plu = {
-            'id': int.from_bytes(response[0:4], 'little'),
-            'code': self._bytes_to_str(response[4:10]),
-            'name1': self._decode_name(response[10:38]),
-            'name2': self._decode_name(response[38:66]),
-            'price': int.from_bytes(response[66:70], 'little'),
-            'expiry': self._parse_expiry(response[70:73]),
-            'tare': int.from_bytes(response[73:75], 'little'),
-            'group_code': self._bytes_to_str(response[75:81]),
-            'message_number': int.from_bytes(response[81:83], 'little'),
-            'last_reset': self.bcd_to_datetime(response[83:89]),
-            'total_sum': int.from_bytes(response[89:93], 'little'),
-            'total_weight': int.from_bytes(response[93:97], 'little'),
-            'sales_count': int.from_bytes(response[97:100], 'little'),
-        }
-
-        return plu
+        self.mirror.put(id, response[:LENGTHS["plu_write"]])
+        return decode_plu(response)
+
+    def _read_plu_record(self, number: int):
+        """Запись PLU из весов (83 байта) без обращения к копии; None - нет записи или ошибка"""
+        response = self._send_command(cmd=COMMANDS["get_plu"], data=number.to_bytes(4, 'little'),
+                                      expected_len=LENGTHS['plu'])
+        if response == ERROR_RESPONSE or not self._check_response(response, LENGTHS["plu"], "PLU"):
+            return None
+        return bytes(response[:LENGTHS["plu_write"]])
+
+    def _read_identity(self):
+        """Заводские настройки весов - по ним копия PLU отличает одни весы от других"""
+        response = self._send_command(cmd=COMMANDS['read_factory_settings'], expected_len=LENGTHS['factory_settings'])
+        if response == ERROR_RESPONSE or not self._check_response(response, LENGTHS['factory_settings'],
+                                                                  'Factory settings read'):
+            return None
+        return bytes(response)
 
     def create_plu(self, data: dict) -> bool:
         if not self.is_ready():
             logging.error("Весы не готовы для создания PLU")
             return False
             
-        plu_bytes = self._encode_plu(data)
-        response = self._send_command(cmd=COMMANDS["create_plu"], data=plu_bytes, expected_len=0)
-        return response != ERROR_RESPONSE
-
-    def _encode_plu(self, data: dict) -> bytes:
-        expire_type = data.get('expiry_type')
-        expiry = data.get('expiry_value')
-        if expire_type == 0:
-            day, month, year = map(int, expiry.split('.'))
-            expiry_bytes = bytes([
-                self._to_bcd(day),
-                self._to_bcd(month),
-                self._to_bcd(year)
-            ])
-        elif expire_type == 1:
-            days = int(expiry)
-            expiry_bytes = bytes([
-                0x00,
-                self._to_bcd(days // 100),
-                self._to_bcd(days % 100)
-            ])
-        else:
-            raise ValueError(f"expire_type должен быть 0 (дата) или 1 (дни)")
-
-        parts = [
-            data['id'].to_bytes(4, 'little'),
-            self._str_to_bytes(data.get('code', '000000')),
-            self._encode_name(data.get('name1', ''), data.get('logo_type', 0), data.get('cert_code', ''), 0),
-            self._encode_name(data.get('name2', ''), data.get('logo_type', 0), data.get('cert_code', ''), 1),
-            int(data['price']).to_bytes(4, 'little'),
-            expiry_bytes,
-            data.get('tare', 0).to_bytes(2, 'little'),
-            self._str_to_bytes(data.get('group_code', '000000')),
-            data.get('message_number', 0).to_bytes(2, 'little'),
-        ]
-        
-        plu_bytes = b''.join(parts)
-        if not self._check_response(plu_bytes, LENGTHS["plu_write"], "PLU Write"):
-            raise ValueError("Invalid PLU length")
-        
-        return plu_bytes
-
-    def _encode_name(self, text: str, logo_type: int, cert_code: str, line: int) -> bytes:
-        max_len = 24 if logo_type else 28
-        encoded = text.encode('cp866', errors='replace')[:max_len]
-        padded = encoded.ljust(max_len, b'\x00')
-        
-        if logo_type:
-            cert_bytes = self._encode_cert_code(cert_code, line, logo_type)
-            return padded + cert_bytes
-        return padded
-
-    def _encode_cert_code(self, cert_code: str, line: int, logo_type: int) -> bytes:
-        code = cert_code.ljust(4, '\x00')
-        return bytes([
-            0,
-            logo_type,
-            ord(code[3 - line]) if len(code) > (3 - line) else 0,
-            ord(code[1 + line]) if len(code) > (1 + line) else 0
-        ])
-
-    def _decode_name(self, name_bytes: bytes) -> str:
-        if name_bytes[24] == 0:
-            raw_name = name_bytes[:24]
-        else:
-            raw_name = name_bytes[:28]
-        return raw_name.split(b'\x00')[0].decode('cp866', errors='ignore')
-
-    def _str_to_bytes(self, s: str) -> bytes:
-        s = s.zfill(6)[:6]
-        return bytes(int(ch) for ch in s)
+        return self.write_plu_record(data['id'], encode_plu(data))
 
-    def _bytes_to_str(self, b: bytes) -> str:
-        return ''.join(str(byte) for byte in b[::-1])
-
-    def _parse_expiry(self, data: bytes):
-        if len(data) != 3:
-            return None
+    def write_plu_record(self, number: int, plu_bytes: bytes, force: bool = False) -> bool:
+        """Пишет в весы готовую 83-байтовую запись PLU; force - писать, даже если копия совпадает"""
+        if not self.is_ready():
+            logging.error("Весы не готовы для создания PLU")
+            return False
 
-        def bcd_to_int(b):
-            return ((b >> 4) * 10) + (b & 0x0F)
+        if not force and self.mirror.get(number) == plu_bytes:
+            logging.debug(f"PLU {number} в весах не изменился, запись пропущена")
+            return True
 
-        if data[0] == 0:
-            hundreds = bcd_to_int(data[1])
-            tens_units = bcd_to_int(data[2])
-            days = hundreds * 100 + tens_units
-            return f"{days}"
+        response = self._send_command(cmd=COMMANDS["create_plu"], data=plu_bytes, expected_len=0)
+        if response == b'':
+            self.mirror.put(number, plu_bytes)
         else:
-            day = bcd_to_int(data[0])
-            month = bcd_to_int(data[1])
-            year = bcd_to_int(data[2])
-            return f"{day:02d}.{month:02d}.{year:02d}"
-
-    @staticmethod
-    def _to_bcd(val):
-        return ((val // 10) << 4) | (val % 10)
-
-    def bcd_to_datetime(self, bcd_data):
-        if len(bcd_data) != 6:
-            return None
-            
-        second = (bcd_data[0] >> 4) * 10 + (bcd_data[0] & 0x0F)
-        minute = (bcd_data[1] >> 4) * 10 + (bcd_data[1] & 0x0F)
-        hour = (bcd_data[2] >> 4) * 10 + (bcd_data[2] & 0x0F)
-        day = (bcd_data[3] >> 4) * 10 + (bcd_data[3] & 0x0F)
-        month = (bcd_data[4] >> 4) * 10 + (bcd_data[4] & 0x0F)
-        year = (bcd_data[5] >> 4) * 10 + (bcd_data[5] & 0x0F) + 2000
-        
-        try:
-            return datetime(year, month, day, hour, minute, second)
-        except ValueError:
-            return None
+            self.mirror.forget(number)
+        return response != ERROR_RESPONSE
 
     # Общие продажи
     def get_total_sales(self) -> dict:
@@ -406,18 +349,7 @@ class ScaleClient:
         if not self._check_response(response, LENGTHS['total_sales'], 'Total sales read'):
             return {}
     
-        return {
-            'mileage': int.from_bytes(response[0:4], 'little'),
-            'label_count': int.from_bytes(response[4:8], 'little'),
-            'total_sum': int.from_bytes(response[8:12], 'little'),
-            'sales_count': int.from_bytes(response[12:15], 'little'),
-            'total_weight': int.from_bytes(response[15:19], 'little'),
-            'plu_sum': int.from_bytes(response[19:23], 'little'),
-            'plu_sales_count': int.from_bytes(response[23:26], 'little'),
-            'plu_weight': int.from_bytes(response[26:30], 'little'),
-            'free_plu': int.from_bytes(response[36:38], 'little'),
-            'free_msg': int.from_bytes(response[38:40], 'little'),
-        }
+        return decode_total_sales(response)
 
     def reset_total_sales(self) -> bool:
         if not self.is_ready():
@@ -425,6 +357,8 @@ class ScaleClient:
             return False
             
         response = self._send_command(cmd=COMMANDS['reset_total_sales'], expected_len=0)
+        if response != ERROR_RESPONSE:
+            self.mirror.clear()
         return response != ERROR_RESPONSE
 
     # Текущее состояние весов
@@ -440,125 +374,104 @@ class ScaleClient:
         if not self._check_response(response, LENGTHS['current_status'], 'Current status read'):
             return {}
         
-        data = response
-        status = data[0]
-        abs_weight = int.from_bytes(data[1:3], "little")
-        if status & 0b10000000:
-            weight = -abs_weight
-        else:
-            weight = abs_weight
-
-        return {
-            "status_byte": status,
-            "weight": weight,
-            "price": int.from_bytes(data[3:7], "little"),
-            "sum": int.from_bytes(data[7:11], "little"),
-            "plu_number": int.from_bytes(data[11:15], "little"),
-            "bits": {
-                "overload": bool(status & 0b00000001),
-                "tare_mode": bool(status & 0b00000100),
-                "zero_weight": bool(status & 0b00001000),
-                "dual_range": bool(status & 0b00100000),
-                "stable_weight": bool(status & 0b01000000),
-                "minus_sign": bool(status & 0b10000000),
-            }
-        }
+        return decode_status(response)
 
 # API функции
-def get_command():
-    url = f"{SERVER_URL}/api/commands/{CLIENT_ID}"
+api = ApiTransport(SERVER_URL, CLIENT_ID, gzip_requests=GZIP_REQUESTS)
+# Все отправки на сервер идут через очередь на диске, см. outbox.py
+outbox = Outbox(api)
+# Большие тела команд, скачанные с сервера, см. blob_cache.py
+blobs = BlobCache()
+
+def get_command(wait=0):
     try:
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
+        return api.get('commands', params={'wait': wait} if wait else None, timeout=REQUEST_TIMEOUT + wait)
     except Exception as e:
         logging.error(f"Ошибка при получении команды: {e}")
         return None
 
-def send_data(data_type, data):
-    url = f"{SERVER_URL}/api/data/{CLIENT_ID}"
+def send_data(data_type, data, batch=None):
     payload = {'data_type': data_type, 'data': data}
-    try:
-        resp = requests.post(url, json=payload, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
-    except Exception as e:
-        logging.error(f"Ошибка при отправке данных: {e}")
-        return None
+    if batch is not None:
+        batch.add('data', **payload)
+    else:
+        outbox.put([{'type': 'data', **payload}])
 
-def send_plu_data(plu_list):
-    url = f"{SERVER_URL}/api/plu_upload/{CLIENT_ID}"
+def send_plu_data(plu_list, batch=None):
     payload = {'plu_list': plu_list}
-    try:
-        resp = requests.post(url, json=payload, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
-    except Exception as e:
-        logging.error(f"Ошибка при отправке PLU данных: {e}")
-        return None
+    if batch is not None:
+        batch.add('plu_upload', **payload)
+    else:
+        outbox.put([{'type': 'plu_upload', **payload}])
 
-def ack_command(command_id):
-    url = f"{SERVER_URL}/api/ack/{CLIENT_ID}"
+def ack_command(command_id, result=None, batch=None):
     payload = {'command_id': command_id}
-    try:
-        resp = requests.post(url, json=payload, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
-    except Exception as e:
-        logging.error(f"Ошибка при подтверждении команды: {e}")
-        return None
-
-def send_status(scale_client):
+    if result:
+        # Сервер по результату отмечает, какие PLU дошли до весов
+        payload['result'] = result.get('result')
+        payload['failed_plu'] = result.get('failed_plu', [])
+    if batch is not None:
+        batch.add('ack', **payload)
+    else:
+        outbox.put([{'type': 'ack', **payload}])
+
+def send_batch(batch):
+    outbox.put(batch.drain(), batch.client_id)
+
+def send_status(scale_client, batch=None):
     status_data = {
         'scales_connected': scale_client.is_ready(),
         'port': scale_client.port,
         'connection_attempts': scale_client._connection_attempts,
+        'outbox_pending': outbox.pending(),
         'timestamp': datetime.now().isoformat()
     }
-    send_data('scales_status', json.dumps(status_data, ensure_ascii=False))
+    send_data('scales_status', status_data, batch)
 
-def execute_command(command_data, scale_client):
+def execute_command(command_data, scale_client, batch=None):
     try:
         command = json.loads(command_data)
         action = command.get('action')
         
+        if action == 'blob':
+            # Само тело команды хранится на сервере отдельно
+            return execute_command(blobs.get(command['blob'], api).decode('utf-8'), scale_client, batch)
+
         if action == 'upload_plu':
             if not scale_client.is_ready():
                 return {'result': 'error', 'message': 'Весы не подключены'}
                 
-            plu_list = command.get('data', [])
+            # refresh - записи пишутся в весы, даже если совпадают с копией
+            refresh = bool(command.get('refresh'))
+            if command.get('records'):
+                # Сервер прислал записи, уже собранные в формат весов
+                records = list(iter_plu_records(base64.b64decode(command['records'])))
+            else:
+                records = [(plu['number'], encode_plu(scale_plu(plu))) for plu in command.get('data', [])]
             success_count = 0
-            for plu in plu_list:
-                scale_plu = {
-                    'id': plu['number'],
-                    'name1': plu['name1'],
-                    'name2': plu.get('name2', ''),
-                    'price': int(float(plu['price']) * 100),
-                    'code': plu.get('code', '000000'),
-                    'group_code': plu.get('group_code', '000000'),
-                    'tare': plu.get('tare', 0),
-                    'message_number': plu.get('message_number', 0),
-                    'expiry_type': plu.get('expiry_type', 0),
-                    'expiry_value': plu.get('expiry_value', '01.01.25'),
-                    'logo_type': plu.get('logo_type', 0),
-                    'cert_code': plu.get('cert_code', '')
-                }
-                if scale_client.create_plu(scale_plu):
+            failed = []
+            for number, plu_bytes in records:
+                if scale_client.write_plu_record(number, plu_bytes, force=refresh):
                     success_count += 1
-                    logging.info(f"Товар {plu['number']} загружен в весы")
+                    logging.info(f"Товар {number} загружен в весы")
                 else:
-                    logging.error(f"Ошибка загрузки товара {plu['number']} в весы")
+                    logging.error(f"Ошибка загрузки товара {number} в весы")
+                    failed.append(number)
             
-            return {'result': 'ok', 'uploaded_count': success_count, 'total_count': len(plu_list)}
+            return {'result': 'ok', 'uploaded_count': success_count, 'total_count': len(records), 'failed_plu': failed}
             
         elif action == 'download_plu':
             if not scale_client.is_ready():
                 return {'result': 'error', 'message': 'Весы не подключены'}
                 
+            # refresh - читать из весов, даже если запись есть в копии
+            refresh = bool(command.get('refresh'))
             numbers = command.get('numbers', [])
             plu_list = []
             for number in numbers:
-                plu = scale_client.get_plu_by_id(number)
+                # Записи, которые клиент сам писал или читал, берутся из копии без обмена с весами
+                record = None if refresh else scale_client.mirror.get(number)
+                plu = decode_plu_record(record) if record else scale_client.get_plu_by_id(number)
                 if plu:
                     server_plu = {
                         'number': plu['id'],
@@ -580,7 +493,7 @@ def execute_command(command_data, scale_client):
                     logging.warning(f"Товар {number} не найден в весах")
             
             if plu_list:
-                send_plu_data(plu_list)
+                send_plu_data(plu_list, batch)
             
             return {'result': 'ok', 'downloaded_count': len(plu_list), 'total_count': len(numbers)}
             
@@ -589,7 +502,7 @@ def execute_command(command_data, scale_client):
                 return {'result': 'error', 'message': 'Весы не подключены'}
                 
             status = scale_client.get_current_status()
-            send_data('current_status', json.dumps(status, ensure_ascii=False))
+            send_data('current_status', status, batch)
             return {'result': 'ok', 'status': status}
             
         elif action == 'get_total_sales':
@@ -597,9 +510,13 @@ def execute_command(command_data, scale_client):
                 return {'result': 'error', 'message': 'Весы не подключены'}
                 
             sales = scale_client.get_total_sales()
-            send_data('total_sales', json.dumps(sales, ensure_ascii=False))
+            send_data('total_sales', sales, batch)
             return {'result': 'ok', 'sales': sales}
             
+        elif action == 'refresh_mirror':
+            scale_client.mirror.clear()
+            return {'result': 'ok', 'message': 'Копия PLU сброшена'}
+            
         elif action == 'reset_total_sales':
             if not scale_client.is_ready():
                 return {'result': 'error', 'message': 'Весы не подключены'}
@@ -619,35 +536,18 @@ def main():
     logging.info(f"Клиент {CLIENT_ID} запущен. Опрос сервера {SERVER_URL}")
     
     scale_client = ScaleClient()
-    send_status(scale_client)
+    runtime = ClientRuntime(sys.modules[__name__], scale_client)
     
     try:
-        while True:
-            if not scale_client.is_ready():
-                scale_client.try_reconnect()
-                send_status(scale_client)
-            
-            cmd_resp = get_command()
-            if cmd_resp and cmd_resp.get('command'):
-                command = cmd_resp['command']
-                command_id = cmd_resp['command_id']
-                
-                logging.info(f"Получена команда: {command}")
-                result = execute_command(command, scale_client)
-                
-                send_data('command_result', json.dumps(result, ensure_ascii=False))
-                ack_command(command_id)
-                
-                logging.info(f"Команда выполнена: {result}")
-            
-            time.sleep(POLL_INTERVAL)
-            
+        asyncio.run(runtime.run())
     except KeyboardInterrupt:
         logging.info("Клиент остановлен пользователем")
     except Exception as e:
         logging.error(f"Критическая ошибка: {e}")
     finally:
         scale_client.disconnect()
+        outbox.close()
+        api.close()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
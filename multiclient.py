@@ -0,0 +1,163 @@
+"""Один клиентский процесс для нескольких весов.
+
+Весы перечисляются в файле настроек (по умолчанию scales.json рядом со
+скриптом):
+
+    {
+        "server_url": "http://your-server-ip:5000",
+        "scales": [
+            {"port": "COM2", "client_id": "scale001"},
+            {"port": "COM3", "client_id": "scale002", "baudrate": 9600}
+        ]
+    }
+
+Каждые весы обслуживает свой ScaleClient из client.py со своей задачей
+переподключения и своей очередью команд, поэтому сбой или долгая команда
+одних весов не задерживает остальные. Команды для всех весов забираются
+одним длинным опросом /api/commands, отправки на сервер идут через общую
+очередь outbox.
+
+    python multiclient.py --config scales.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+
+import client
+from api_transport import ApiBatch, ApiTransport
+from async_runtime import HEALTH_INTERVAL, RUNTIME_WORKERS, DaemonExecutor, outbox_step, run_blocking, run_forever
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scales.json')
+
+
+class ScaleWorker:
+    """Весы на одном порту: переподключение и выполнение команд по очереди"""
+    def __init__(self, client_id, scale_client, executor):
+        self.client_id = client_id
+        self.scale_client = scale_client
+        self.executor = executor
+        self.commands = asyncio.Queue()
+        self._lock = asyncio.Lock()
+
+    async def _scale(self, fn, *args):
+        async with self._lock:
+            return await run_blocking(self.executor, fn, *args)
+
+    async def send_status(self):
+        batch = ApiBatch(client.api, self.client_id)
+        client.send_status(self.scale_client, batch)
+        await run_blocking(self.executor, client.send_batch, batch)
+
+    async def health_step(self):
+        if not self.scale_client.is_ready():
+            await self._scale(self.scale_client.try_reconnect)
+            await self.send_status()
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def command_step(self):
+        cmd = await self.commands.get()
+        command = cmd['command']
+        command_id = cmd['command_id']
+
+        logging.info(f"[{self.client_id}] Получена команда: {command}")
+        batch = ApiBatch(client.api, self.client_id)
+        result = await self._scale(client.execute_command, command, self.scale_client, batch)
+
+        client.send_data('command_result', result, batch)
+        client.ack_command(command_id, result, batch)
+        await run_blocking(self.executor, client.send_batch, batch)
+
+        logging.info(f"[{self.client_id}] Команда выполнена: {result}")
+
+
+class MultiClientRuntime:
+    def __init__(self, scales):
+        self.scales = scales
+        self.workers = {}
+        # Каждым весам - проверка подключения и команда, плюс общая очередь отправки
+        self.executor = DaemonExecutor(max(2 * len(scales) + 1, RUNTIME_WORKERS), 'runtime')
+        self.poll_executor = DaemonExecutor(1, 'long-poll')
+
+    async def _poll_step(self):
+        try:
+            resp = await run_blocking(self.poll_executor, client.api.poll_commands, list(self.workers),
+                                      client.LONG_POLL_TIMEOUT)
+        except Exception as e:
+            logging.error(f"Ошибка при получении команд: {e}")
+            await asyncio.sleep(client.POLL_INTERVAL)
+            return
+        for cmd in resp.get('commands', []):
+            worker = self.workers.get(cmd['client_id'])
+            if worker:
+                worker.commands.put_nowait(cmd)
+
+    async def run(self):
+        # Подключение ко всем весам идет параллельно
+        scale_clients = await asyncio.gather(*(
+            run_blocking(self.executor, client.ScaleClient, port=scale['port'],
+                         baudrate=scale.get('baudrate', client.BAUDRATE))
+            for scale in self.scales
+        ))
+        for scale, scale_client in zip(self.scales, scale_clients):
+            self.workers[scale['client_id']] = ScaleWorker(scale['client_id'], scale_client, self.executor)
+
+        await asyncio.gather(*(worker.send_status() for worker in self.workers.values()))
+        tasks = [
+            asyncio.create_task(run_forever('commands', self._poll_step)),
+            asyncio.create_task(run_forever('outbox', lambda: outbox_step(client.outbox, self.executor))),
+        ]
+        for client_id, worker in self.workers.items():
+            tasks.append(asyncio.create_task(run_forever(f'health {client_id}', worker.health_step)))
+            tasks.append(asyncio.create_task(run_forever(f'commands {client_id}', worker.command_step)))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            client.outbox.stop()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.poll_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def load_config(path):
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    scales = config.get('scales') or []
+    if not scales:
+        raise SystemExit(f"В {path} не указаны весы")
+    for key in ('port', 'client_id'):
+        values = [scale[key] for scale in scales]
+        if len(set(values)) != len(values):
+            raise SystemExit(f"В {path} повторяются значения {key}")
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Клиент для нескольких весов')
+    parser.add_argument('--config', default=CONFIG_PATH, help='файл со списком весов')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    server_url = config.get('server_url', client.SERVER_URL)
+    client_ids = [scale['client_id'] for scale in config['scales']]
+    client.api = ApiTransport(server_url, client_ids[0], gzip_requests=client.GZIP_REQUESTS)
+    client.outbox.transport = client.api
+    logging.info(f"Клиент для весов {', '.join(client_ids)} запущен. Опрос сервера {server_url}")
+
+    runtime = MultiClientRuntime(config['scales'])
+    try:
+        asyncio.run(runtime.run())
+    except KeyboardInterrupt:
+        logging.info("Клиент остановлен пользователем")
+    except Exception as e:
+        logging.error(f"Критическая ошибка: {e}")
+    finally:
+        for worker in runtime.workers.values():
+            worker.scale_client.disconnect()
+        client.outbox.close()
+        client.api.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Очередь исходящих сообщений клиента на сервер в SQLite рядом с клиентом.
+
+Все, что клиент отправляет на сервер (данные, выгруженные PLU,
+подтверждения команд), сначала записывается в очередь, а задача отправки
+клиента (outbox_step в async_runtime.py) шагами flush_step/wait отправляет
+ее по порядку пакетами через POST /api/batch. Пока сервер
+недоступен, сообщения копятся на диске и переживают перезапуск клиента;
+паузы между попытками растут со случайным разбросом, чтобы после общей
+аварии клиенты не пришли на сервер одновременно. Каждый элемент получает
+uid, по которому сервер отбрасывает повторную доставку.
+"""
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import uuid
+from itertools import takewhile
+
+import requests
+
+OUTBOX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outbox.db')
+OUTBOX_BATCH = 100  # Элементов в одном запросе
+OUTBOX_IDLE = 5  # Проверка очереди без новых сообщений (секунды)
+OUTBOX_RETRY_MIN = 1  # Первая пауза после ошибки отправки (секунды)
+OUTBOX_RETRY_MAX = 300  # Наибольшая пауза после ошибок (секунды)
+# Ответы, которые при повторе не изменятся: такой пакет отбрасывается, чтобы не держать очередь
+DROP_STATUSES = (400, 413)
+
+
+class Outbox:
+    def __init__(self, transport, path: str = OUTBOX_PATH):
+        self.transport = transport
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._delay = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            ' seq INTEGER PRIMARY KEY AUTOINCREMENT, client_id TEXT NOT NULL, item TEXT NOT NULL)'
+        )
+        self._db.commit()
+
+    def put(self, items, client_id: str = None):
+        """Записывает элементы в очередь одной транзакцией"""
+        if not items:
+            return
+        client_id = client_id or self.transport.client_id
+        rows = []
+        for item in items:
+            item = dict(item, uid=uuid.uuid4().hex)
+            rows.append((client_id, json.dumps(item, ensure_ascii=False)))
+        with self._lock:
+            self._db.executemany('INSERT INTO outbox (client_id, item) VALUES (?, ?)', rows)
+            self._db.commit()
+        self._wake.set()
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def flush_once(self) -> bool:
+        """Отправляет самые старые элементы одного клиента, False - если очередь пуста"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT seq, client_id, item FROM outbox ORDER BY seq LIMIT ?', (OUTBOX_BATCH,)
+            ).fetchall()
+        if not rows:
+            return False
+        client_id = rows[0][1]
+        rows = list(takewhile(lambda row: row[1] == client_id, rows))
+        items = [json.loads(row[2]) for row in rows]
+        try:
+            self.transport.post('batch', {'items': items}, client_id=client_id)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code not in DROP_STATUSES:
+                raise
+            logging.error(f"Сервер отклонил пакет из {len(items)} элементов ({e}), пакет отброшен")
+        with self._lock:
+            self._db.execute('DELETE FROM outbox WHERE seq BETWEEN ? AND ?', (rows[0][0], rows[-1][0]))
+            self._db.commit()
+        return True
+
+    def flush_step(self) -> float:
+        """Одна попытка отправки; возвращает паузу до следующей (секунды)"""
+        self._wake.clear()
+        try:
+            sent = self.flush_once()
+        except Exception as e:
+            self._delay = min(max(self._delay * 2, OUTBOX_RETRY_MIN), OUTBOX_RETRY_MAX)
+            logging.error(f"Ошибка отправки очереди на сервер: {e}, повтор через {self._delay} с")
+            return self._delay * random.uniform(0.5, 1.5)
+        if self._delay:
+            logging.info(f"Связь с сервером восстановлена, в очереди {self.pending()} элементов")
+            self._delay = 0
+        return 0 if sent else OUTBOX_IDLE
+
+    def wait(self, pause: float):
+        """Ждет паузу; без ошибок отправки новые сообщения прерывают ожидание"""
+        if pause and not self._stop.is_set():
+            (self._stop if self._delay else self._wake).wait(pause)
+
+    def stop(self):
+        """Прерывает текущее и последующие ожидания wait - при остановке клиента"""
+        self._stop.set()
+        self._wake.set()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,109 @@
+"""Копия записей PLU, загруженных в весы, в SQLite рядом с клиентом.
+
+Хранит 83-байтовую запись каждого PLU в том виде, в каком она ушла в
+весы или была из них прочитана. По ней клиент пропускает повторную
+запись неизменившихся PLU и отвечает на download_plu без обмена с весами.
+
+При каждом подключении копия сверяется с весами на порту (check_scale):
+заводские настройки, счетчик пробега и несколько записей PLU,
+прочитанных из весов заново. Любое расхождение сбрасывает копию.
+"""
+import logging
+import os
+import sqlite3
+import threading
+
+MIRROR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plu_mirror.db')
+MIRROR_CHECK_SAMPLES = 3  # Сколько записей копии сверять с весами при подключении
+
+
+class PLUMirror:
+    def __init__(self, scale_key: str, path: str = MIRROR_PATH):
+        self.scale_key = scale_key
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS plu ('
+            ' scale_key TEXT NOT NULL, number INTEGER NOT NULL, record BLOB NOT NULL,'
+            ' PRIMARY KEY (scale_key, number))'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS scale_check ('
+            ' scale_key TEXT PRIMARY KEY, identity BLOB, mileage INTEGER)'
+        )
+        self._db.commit()
+
+    def get(self, number: int):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT record FROM plu WHERE scale_key = ? AND number = ?', (self.scale_key, number)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, number: int, record: bytes):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO plu (scale_key, number, record) VALUES (?, ?, ?)',
+                (self.scale_key, number, bytes(record))
+            )
+            self._db.commit()
+
+    def forget(self, number: int):
+        with self._lock:
+            self._db.execute('DELETE FROM plu WHERE scale_key = ? AND number = ?', (self.scale_key, number))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM plu WHERE scale_key = ?', (self.scale_key,))
+            self._db.commit()
+        logging.info(f"Копия PLU весов {self.scale_key} сброшена")
+
+    def check_scale(self, identity: bytes, totals: dict, read_record) -> bool:
+        """Сверяет копию с весами на порту, сбрасывает ее, если весы другие или изменены.
+
+        identity - заводские настройки весов, totals - общие продажи,
+        read_record(number) - запись PLU, прочитанная из весов (None - нет
+        записи или ошибка обмена). Пробег весов не уменьшается (в отличие
+        от остальных счетчиков, его не сбрасывает reset_total_sales), а
+        выборочные записи PLU должны совпасть с копией байт в байт.
+        Возвращает True, если копия сохранена.
+        """
+        mileage = totals.get('mileage') if totals else None
+        with self._lock:
+            row = self._db.execute(
+                'SELECT identity, mileage FROM scale_check WHERE scale_key = ?', (self.scale_key,)
+            ).fetchone()
+            samples = self._db.execute(
+                'SELECT number, record FROM plu WHERE scale_key = ? ORDER BY RANDOM() LIMIT ?',
+                (self.scale_key, MIRROR_CHECK_SAMPLES)
+            ).fetchall()
+
+        reason = None
+        if samples and row is None:
+            reason = "нет сведений о весах, с которых заполнена копия"
+        elif row and identity is not None and row[0] is not None and bytes(row[0]) != identity:
+            reason = "изменились заводские настройки"
+        elif row and mileage is not None and row[1] is not None and mileage < row[1]:
+            reason = f"пробег уменьшился ({row[1]} -> {mileage})"
+        else:
+            for number, record in samples:
+                if read_record(number) != bytes(record):
+                    reason = f"PLU {number} в весах не совпадает с копией"
+                    break
+        if reason:
+            logging.warning(f"Весы на {self.scale_key} не совпадают с копией PLU: {reason}")
+            self.clear()
+
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO scale_check (scale_key, identity, mileage) VALUES (?, ?, ?)',
+                (self.scale_key, identity, mileage)
+            )
+            self._db.commit()
+        return reason is None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
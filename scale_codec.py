@@ -0,0 +1,253 @@
+"""Раскладки байт протокола CAS LP 1.6.
+
+Общий модуль для client.py, casclient.py, имитатора весов и сервера.
+Форматы записей описаны заранее скомпилированными struct.Struct, разбор
+идет через unpack_from по memoryview без копирования исходного буфера,
+поэтому из одного непрерывного буфера можно разбирать и собирать сразу
+много записей PLU.
+"""
+import struct
+from datetime import datetime
+
+# Запись PLU при записи в весы (83 байта): номер, код, два названия, цена,
+# срок годности (BCD), тара, групповой код, номер сообщения
+PLU_RECORD = struct.Struct('<I6s28s28sI3sH6sH')
+# Запись PLU при чтении (100 байт): запись PLU + дата сброса (BCD) и итоги
+PLU_READ = struct.Struct('<I6s28s28sI3sH6sH6sII3s')
+# Текущее состояние (15 байт): байт статуса, вес, цена, сумма, номер PLU
+STATUS = struct.Struct('<BHIII')
+# Общие продажи (40 байт), байты 30-35 не используются
+TOTAL_SALES = struct.Struct('<III3sII3sI6xHH')
+
+_BCD_TO_INT = [((b >> 4) * 10) + (b & 0x0F) for b in range(256)]
+_DIGIT_BYTES = bytes(range(10))
+_DIGITS_TO_ASCII = bytes.maketrans(_DIGIT_BYTES, b'0123456789')
+_ASCII_TO_DIGITS = bytes.maketrans(b'0123456789', _DIGIT_BYTES)
+
+STATUS_BITS = (
+    ('overload', 0b00000001),
+    ('tare_mode', 0b00000100),
+    ('zero_weight', 0b00001000),
+    ('dual_range', 0b00100000),
+    ('stable_weight', 0b01000000),
+    ('minus_sign', 0b10000000),
+)
+
+
+# --- Поля ---
+def to_bcd(val):
+    return ((val // 10) << 4) | (val % 10)
+
+
+def digits_to_bytes(s: str) -> bytes:
+    """Строка цифр -> 6 байт, по цифре в байте"""
+    s = s.zfill(6)[:6]
+    if not (s.isascii() and s.isdigit()):
+        raise ValueError(f"Код должен состоять из цифр: {s!r}")
+    return s.encode('ascii').translate(_ASCII_TO_DIGITS)
+
+
+def bytes_to_digits(b) -> str:
+    """6 байт по цифре в байте -> строка, младший разряд первым"""
+    raw = bytes(b)[::-1]
+    if raw.translate(None, _DIGIT_BYTES):
+        return ''.join(str(byte) for byte in raw)
+    return raw.translate(_DIGITS_TO_ASCII).decode('ascii')
+
+
+def encode_name(text: str, logo_type: int, cert_code: str, line: int) -> bytes:
+    max_len = 24 if logo_type else 28
+    encoded = text.encode('cp866', errors='replace')[:max_len]
+    padded = encoded.ljust(max_len, b'\x00')
+
+    if logo_type:
+        return padded + encode_cert_code(cert_code, line, logo_type)
+    return padded
+
+
+def encode_cert_code(cert_code: str, line: int, logo_type: int) -> bytes:
+    code = cert_code.ljust(4, '\x00')
+    return bytes([
+        0,
+        logo_type,
+        ord(code[3 - line]) if len(code) > (3 - line) else 0,
+        ord(code[1 + line]) if len(code) > (1 + line) else 0
+    ])
+
+
+def decode_name(name_bytes: bytes) -> str:
+    raw_name = name_bytes[:24] if name_bytes[24] == 0 else name_bytes[:28]
+    return raw_name.split(b'\x00')[0].decode('cp866', errors='ignore')
+
+
+def encode_expiry(expire_type, expiry) -> bytes:
+    if expire_type == 0:
+        day, month, year = map(int, expiry.split('.'))
+        return bytes([to_bcd(day), to_bcd(month), to_bcd(year)])
+    elif expire_type == 1:
+        days = int(expiry)
+        return bytes([0x00, to_bcd(days // 100), to_bcd(days % 100)])
+    raise ValueError(f"expire_type должен быть 0 (дата) или 1 (дни)")
+
+
+def decode_expiry(data: bytes):
+    if len(data) != 3:
+        return None
+    if data[0] == 0:
+        return f"{_BCD_TO_INT[data[1]] * 100 + _BCD_TO_INT[data[2]]}"
+    return f"{_BCD_TO_INT[data[0]]:02d}.{_BCD_TO_INT[data[1]]:02d}.{_BCD_TO_INT[data[2]]:02d}"
+
+
+def bcd_to_datetime(bcd_data):
+    if len(bcd_data) != 6:
+        return None
+    second, minute, hour, day, month, year = (_BCD_TO_INT[b] for b in bcd_data)
+    try:
+        return datetime(year + 2000, month, day, hour, minute, second)
+    except ValueError:
+        return None
+
+
+# --- PLU ---
+def encode_plu_into(buffer, offset: int, data: dict):
+    """Пишет 83-байтовую запись PLU в buffer начиная с offset"""
+    logo_type = data.get('logo_type', 0)
+    cert_code = data.get('cert_code', '')
+    PLU_RECORD.pack_into(
+        buffer, offset,
+        data['id'],
+        digits_to_bytes(data.get('code', '000000')),
+        encode_name(data.get('name1', ''), logo_type, cert_code, 0),
+        encode_name(data.get('name2', ''), logo_type, cert_code, 1),
+        int(data['price']),
+        encode_expiry(data.get('expiry_type'), data.get('expiry_value')),
+        data.get('tare', 0),
+        digits_to_bytes(data.get('group_code', '000000')),
+        data.get('message_number', 0),
+    )
+
+
+def scale_plu(plu: dict) -> dict:
+    """PLU в виде, как его хранит сервер (цена в рублях), -> поля записи для весов"""
+    return {
+        'id': plu['number'],
+        'name1': plu['name1'],
+        'name2': plu.get('name2', ''),
+        'price': int(float(plu['price']) * 100),
+        'code': plu.get('code', '000000'),
+        'group_code': plu.get('group_code', '000000'),
+        'tare': plu.get('tare', 0),
+        'message_number': plu.get('message_number', 0),
+        'expiry_type': plu.get('expiry_type', 0),
+        'expiry_value': plu.get('expiry_value', '01.01.25'),
+        'logo_type': plu.get('logo_type', 0),
+        'cert_code': plu.get('cert_code', '')
+    }
+
+
+def encode_plu(data: dict) -> bytes:
+    buffer = bytearray(PLU_RECORD.size)
+    encode_plu_into(buffer, 0, data)
+    return bytes(buffer)
+
+
+def encode_plus(plu_list) -> bytearray:
+    """Собирает записи PLU в один непрерывный буфер по 83 байта на запись"""
+    buffer = bytearray(PLU_RECORD.size * len(plu_list))
+    for index, data in enumerate(plu_list):
+        encode_plu_into(buffer, index * PLU_RECORD.size, data)
+    return buffer
+
+
+def iter_plu_records(buf):
+    """Номер и 83-байтовая запись для подряд идущих записей PLU, готовых к записи в весы"""
+    view = memoryview(buf)
+    for offset in range(0, len(view) - PLU_RECORD.size + 1, PLU_RECORD.size):
+        record = view[offset:offset + PLU_RECORD.size]
+        yield int.from_bytes(record[:4], 'little'), bytes(record)
+
+
+def _plu_fields(number, code, name1, name2, price, expiry, tare, group_code, message_number):
+    return {
+        'id': number,
+        'code': bytes_to_digits(code),
+        'name1': decode_name(name1),
+        'name2': decode_name(name2),
+        'price': price,
+        'expiry': decode_expiry(expiry),
+        'tare': tare,
+        'group_code': bytes_to_digits(group_code),
+        'message_number': message_number,
+    }
+
+
+def decode_plu_record(buf, offset: int = 0) -> dict:
+    """Разбирает 83-байтовую запись PLU (в том виде, как она пишется в весы)"""
+    return _plu_fields(*PLU_RECORD.unpack_from(buf, offset))
+
+
+def decode_plu(buf, offset: int = 0) -> dict:
+    """Разбирает 100-байтовый ответ на чтение PLU"""
+    fields = PLU_READ.unpack_from(buf, offset)
+    plu = _plu_fields(*fields[:9])
+    last_reset, total_sum, total_weight, sales_count = fields[9:]
+    plu['last_reset'] = bcd_to_datetime(last_reset)
+    plu['total_sum'] = total_sum
+    plu['total_weight'] = total_weight
+    plu['sales_count'] = int.from_bytes(sales_count, 'little')
+    return plu
+
+
+def iter_plus(buf):
+    """Разбирает подряд идущие 100-байтовые записи PLU из одного буфера"""
+    view = memoryview(buf)
+    for offset in range(0, len(view) - PLU_READ.size + 1, PLU_READ.size):
+        yield decode_plu(view, offset)
+
+
+def decode_plus(buf) -> list:
+    return list(iter_plus(buf))
+
+
+# --- Состояние и итоги ---
+def decode_status(buf, offset: int = 0) -> dict:
+    status, abs_weight, price, total, plu_number = STATUS.unpack_from(buf, offset)
+    return {
+        "status_byte": status,
+        "weight": -abs_weight if status & 0b10000000 else abs_weight,
+        "price": price,
+        "sum": total,
+        "plu_number": plu_number,
+        "bits": {name: bool(status & mask) for name, mask in STATUS_BITS},
+    }
+
+
+def encode_status(status: dict) -> bytes:
+    return STATUS.pack(status['status_byte'], abs(status['weight']), status['price'],
+                       status['sum'], status['plu_number'])
+
+
+def decode_total_sales(buf, offset: int = 0) -> dict:
+    (mileage, label_count, total_sum, sales_count, total_weight, plu_sum,
+     plu_sales_count, plu_weight, free_plu, free_msg) = TOTAL_SALES.unpack_from(buf, offset)
+    return {
+        'mileage': mileage,
+        'label_count': label_count,
+        'total_sum': total_sum,
+        'sales_count': int.from_bytes(sales_count, 'little'),
+        'total_weight': total_weight,
+        'plu_sum': plu_sum,
+        'plu_sales_count': int.from_bytes(plu_sales_count, 'little'),
+        'plu_weight': plu_weight,
+        'free_plu': free_plu,
+        'free_msg': free_msg,
+    }
+
+
+def encode_total_sales(totals: dict) -> bytes:
+    return TOTAL_SALES.pack(
+        totals['mileage'], totals['label_count'], totals['total_sum'],
+        totals['sales_count'].to_bytes(3, 'little'), totals['total_weight'],
+        totals['plu_sum'], totals['plu_sales_count'].to_bytes(3, 'little'),
+        totals['plu_weight'], totals['free_plu'], totals['free_msg'],
+    )
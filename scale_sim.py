@@ -0,0 +1,347 @@
+"""Имитатор весов CAS LP 1.6 на псевдотерминале Linux.
+
+Отвечает на команды из COMMANDS client.py с теми же раскладками байт,
+что ожидает ScaleClient, поэтому client.py и casclient.py работают с ним
+без изменений: достаточно указать им порт, который печатает имитатор.
+
+    python scale_sim.py --wire-speed --jitter 0.02 --error-rate 0.01
+"""
+import argparse
+import logging
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+from datetime import datetime
+
+from client import COMMANDS, LENGTHS, BAUDRATE
+from scale_codec import decode_plu_record, encode_status, encode_total_sales, to_bcd
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+WAKE = b'\x01'
+READY = b'\x80'
+ERROR = b'\xEE'
+
+PLU_CAPACITY = 10000
+MESSAGE_CAPACITY = 1000
+
+# Длины данных, которые весы принимают после кода команды.
+# Номер сообщения передается двумя байтами, запись сообщения - номер + 400 байт текста.
+REQUEST_LENGTHS = {
+    COMMANDS["read_logo2"]: 0,
+    COMMANDS["write_logo2"]: LENGTHS["logo2"],
+    COMMANDS["write_logo_roste"]: LENGTHS["logo_roste"],
+    COMMANDS["read_user_settings"]: 0,
+    COMMANDS["write_user_settings"]: LENGTHS["user_settings"],
+    COMMANDS["read_factory_settings"]: 0,
+    COMMANDS["get_status"]: 0,
+    COMMANDS["get_plu"]: LENGTHS["plu_code"],
+    COMMANDS["delete_plu"]: LENGTHS["plu_code"],
+    COMMANDS["create_plu"]: LENGTHS["plu_write"],
+    COMMANDS["get_message"]: 2,
+    COMMANDS["create_message"]: LENGTHS["message_write"],
+    COMMANDS["delete_message"]: 2,
+    COMMANDS["reset_plu_totals"]: 0,
+    COMMANDS["get_total_sales"]: 0,
+    COMMANDS["reset_total_sales"]: 0,
+}
+
+
+def _bcd_now():
+    now = datetime.now()
+    return bytes(to_bcd(v) for v in (now.second, now.minute, now.hour, now.day, now.month, now.year % 100))
+
+
+class ScaleSimulator:
+    """Весы CAS LP 1.6, подключенные к ведомой стороне pty.
+
+    wire_speed - отдавать ответы со скоростью линии baudrate (8N1),
+    jitter - случайная задержка перед ответом до указанного числа секунд,
+    error_rate - доля команд, на которые весы отвечают 0xEE,
+    ready_delay - пауза между кадром ответа и байтом готовности 0x80.
+    """
+
+    def __init__(self, baudrate=BAUDRATE, wire_speed=False, jitter=0.0, error_rate=0.0,
+                 ready_delay=0.0, plu_capacity=PLU_CAPACITY, seed=None):
+        self.baudrate = baudrate
+        self.wire_speed = wire_speed
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.ready_delay = ready_delay
+        self.plu_capacity = plu_capacity
+        self._random = random.Random(seed)
+
+        self.plus = {}       # номер -> 83 байта записи PLU
+        self.plu_totals = {}  # номер -> [сумма, вес, количество продаж, BCD даты сброса]
+        self.messages = {}   # номер -> 400 байт текста
+        self.user_settings = bytes(LENGTHS["user_settings"])
+        self.factory_settings = bytes(LENGTHS["factory_settings"])
+        self.logo2 = bytes(LENGTHS["logo2"])
+        self.logo_roste = bytes(LENGTHS["logo_roste"])
+        self.totals = {
+            'mileage': 0, 'label_count': 0, 'total_sum': 0, 'sales_count': 0, 'total_weight': 0,
+            'plu_sum': 0, 'plu_sales_count': 0, 'plu_weight': 0,
+        }
+        self.status = {'status_byte': 0b01001000, 'weight': 0, 'price': 0, 'sum': 0, 'plu_number': 0}
+        self.command_counts = {}
+
+        self._lock = threading.Lock()
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self.port = None
+
+    # --- Управление ---
+    def start(self):
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name='scale-sim', daemon=True)
+        self._thread.start()
+        logging.info(f"Имитатор весов запущен на {self.port}")
+        return self.port
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout=2)
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+        logging.info("Имитатор весов остановлен")
+
+    # --- Состояние весов ---
+    def set_status(self, weight=0, price=0, plu_number=0, stable=True, tare_mode=False, overload=False):
+        status = 0
+        if overload:
+            status |= 0b00000001
+        if tare_mode:
+            status |= 0b00000100
+        if weight == 0:
+            status |= 0b00001000
+        if stable:
+            status |= 0b01000000
+        if weight < 0:
+            status |= 0b10000000
+        with self._lock:
+            self.status = {
+                'status_byte': status,
+                'weight': abs(weight),
+                'price': price,
+                'sum': abs(weight) * price // 1000,
+                'plu_number': plu_number,
+            }
+
+    def register_sale(self, plu_number, weight):
+        """Продажа по PLU: обновляет итоги так, как это сделала бы печать этикетки"""
+        with self._lock:
+            record = self.plus.get(plu_number)
+            price = decode_plu_record(record)['price'] if record else 0
+            amount = weight * price // 1000
+            totals = self.plu_totals.setdefault(plu_number, [0, 0, 0, _bcd_now()])
+            totals[0] += amount
+            totals[1] += weight
+            totals[2] += 1
+            for key, value in (('total_sum', amount), ('total_weight', weight), ('sales_count', 1),
+                               ('plu_sum', amount), ('plu_weight', weight), ('plu_sales_count', 1),
+                               ('label_count', 1), ('mileage', 1)):
+                self.totals[key] += value
+
+    # --- Обмен ---
+    def _serve(self):
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                byte = os.read(self._master, 1)
+            except OSError:
+                break
+            if byte == WAKE:
+                self._write(READY)
+                continue
+            if byte not in REQUEST_LENGTHS:
+                logging.debug(f"Пропущен байт: {byte.hex()}")
+                continue
+            data = self._read_exact(REQUEST_LENGTHS[byte])
+            if data is None:
+                break
+            self._handle(byte, data)
+
+    def _read_exact(self, size):
+        buffer = bytearray()
+        while len(buffer) < size and self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if ready:
+                buffer += os.read(self._master, size - len(buffer))
+        if len(buffer) < size:
+            return None
+        if self.wire_speed:
+            time.sleep(self._wire_time(size))
+        return bytes(buffer)
+
+    def _wire_time(self, size):
+        return size * 10.0 / self.baudrate
+
+    def _write(self, data):
+        if not self.wire_speed:
+            view = memoryview(data)
+            while view:
+                written = os.write(self._master, view)
+                view = view[written:]
+            return
+        # Отдаем порциями по расписанию, чтобы не накапливать ошибку sleep()
+        start = time.monotonic()
+        for offset in range(0, len(data), 8):
+            chunk = data[offset:offset + 8]
+            delay = start + self._wire_time(offset + len(chunk)) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            os.write(self._master, chunk)
+
+    def _handle(self, cmd, data):
+        self.command_counts[cmd] = self.command_counts.get(cmd, 0) + 1
+        if self.jitter:
+            time.sleep(self._random.uniform(0, self.jitter))
+        if self.error_rate and self._random.random() < self.error_rate:
+            self._write(ERROR + READY)
+            return
+
+        with self._lock:
+            try:
+                reply = self._execute(cmd, data)
+            except Exception as e:
+                logging.error(f"Ошибка обработки команды {cmd.hex()}: {e}")
+                reply = None
+
+        if reply is None:
+            self._write(ERROR + READY)
+        elif reply:
+            self._write(cmd + reply)
+            if self.ready_delay:
+                time.sleep(self.ready_delay)
+            self._write(READY)
+        else:
+            self._write(READY)
+
+    def _execute(self, cmd, data):
+        """Возвращает тело ответа, b'' для команд записи или None для ответа 0xEE"""
+        if cmd == COMMANDS["get_status"]:
+            return self._encode_status()
+        if cmd == COMMANDS["get_plu"]:
+            number = int.from_bytes(data, 'little')
+            record = self.plus.get(number)
+            if record is None:
+                return None
+            total_sum, total_weight, sales_count, last_reset = self.plu_totals.get(number, [0, 0, 0, bytes(6)])
+            return b''.join([
+                record,
+                last_reset,
+                total_sum.to_bytes(4, 'little'),
+                total_weight.to_bytes(4, 'little'),
+                sales_count.to_bytes(3, 'little'),
+            ])
+        if cmd == COMMANDS["create_plu"]:
+            number = int.from_bytes(data[0:4], 'little')
+            if number not in self.plus and len(self.plus) >= self.plu_capacity:
+                return None
+            self.plus[number] = data
+            return b''
+        if cmd == COMMANDS["delete_plu"]:
+            number = int.from_bytes(data, 'little')
+            if self.plus.pop(number, None) is None:
+                return None
+            self.plu_totals.pop(number, None)
+            return b''
+        if cmd == COMMANDS["reset_plu_totals"]:
+            reset = _bcd_now()
+            self.plu_totals = {number: [0, 0, 0, reset] for number in self.plus}
+            return b''
+        if cmd == COMMANDS["get_message"]:
+            number = int.from_bytes(data, 'little')
+            return self.messages.get(number)
+        if cmd == COMMANDS["create_message"]:
+            number = int.from_bytes(data[0:2], 'little')
+            if number not in self.messages and len(self.messages) >= MESSAGE_CAPACITY:
+                return None
+            self.messages[number] = data[2:]
+            return b''
+        if cmd == COMMANDS["delete_message"]:
+            number = int.from_bytes(data, 'little')
+            if self.messages.pop(number, None) is None:
+                return None
+            return b''
+        if cmd == COMMANDS["get_total_sales"]:
+            return self._encode_total_sales()
+        if cmd == COMMANDS["reset_total_sales"]:
+            for key in self.totals:
+                if key != 'mileage':
+                    self.totals[key] = 0
+            return b''
+        if cmd == COMMANDS["read_user_settings"]:
+            return self.user_settings
+        if cmd == COMMANDS["write_user_settings"]:
+            self.user_settings = data
+            return b''
+        if cmd == COMMANDS["read_factory_settings"]:
+            return self.factory_settings
+        if cmd == COMMANDS["read_logo2"]:
+            return self.logo2
+        if cmd == COMMANDS["write_logo2"]:
+            self.logo2 = data
+            return b''
+        if cmd == COMMANDS["write_logo_roste"]:
+            self.logo_roste = data
+            return b''
+        return None
+
+    def _encode_status(self):
+        return encode_status(self.status)
+
+    def _encode_total_sales(self):
+        totals = dict(self.totals)
+        totals['free_plu'] = self.plu_capacity - len(self.plus)
+        totals['free_msg'] = MESSAGE_CAPACITY - len(self.messages)
+        return encode_total_sales(totals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Имитатор весов CAS LP 1.6 на псевдотерминале')
+    parser.add_argument('--baudrate', type=int, default=BAUDRATE)
+    parser.add_argument('--wire-speed', action='store_true', help='отдавать ответы со скоростью линии')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная задержка ответа, секунды')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 0xEE (0..1)')
+    parser.add_argument('--ready-delay', type=float, default=0.0, help='пауза перед байтом 0x80, секунды')
+    parser.add_argument('--link', help='создать символическую ссылку на порт (например /tmp/ttyCAS0)')
+    args = parser.parse_args()
+
+    sim = ScaleSimulator(baudrate=args.baudrate, wire_speed=args.wire_speed, jitter=args.jitter,
+                         error_rate=args.error_rate, ready_delay=args.ready_delay)
+    port = sim.start()
+    if args.link:
+        if os.path.lexists(args.link):
+            os.remove(args.link)
+        os.symlink(port, args.link)
+        port = args.link
+    print(f"SERIAL_PORT = '{port}'")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.info("Имитатор остановлен пользователем")
+    finally:
+        sim.stop()
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
+
+if __name__ == '__main__':
+    main()
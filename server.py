@@ -1,13 +1,57 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, flash, abort
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+import click
+from datetime import datetime, timedelta
+import atexit
+import base64
+import gzip
+import hashlib
+import io
 import json
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from scale_codec import encode_plu, scale_plu
+from status_series import (CHUNK_SECONDS, StatusReading, chunk_start, decode_readings, downsample, encode_readings,
+                           encode_run, from_ms, to_ms)
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///admin_server.db'
+# Столбцы JSON хранятся компактно и без экранирования кириллицы
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'json_serializer': lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':')),
+}
 app.secret_key = 'your-secret-key-here'  # Для flash сообщений
 db = SQLAlchemy(app)
 
+MAX_REQUEST_BODY = 32 * 1024 * 1024  # Предел распакованного тела запроса (байты)
+
+class GzipRequestMiddleware:
+    """Распаковывает тела запросов с Content-Encoding: gzip от клиентов весов"""
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            try:
+                with gzip.GzipFile(fileobj=io.BytesIO(environ['wsgi.input'].read(length))) as f:
+                    body = f.read(MAX_REQUEST_BODY + 1)
+            except (OSError, EOFError, zlib.error):
+                start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+                return [b'Invalid gzip body']
+            if len(body) > MAX_REQUEST_BODY:
+                start_response('413 Request Entity Too Large', [('Content-Type', 'text/plain')])
+                return [b'Request body too large']
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = GzipRequestMiddleware(app.wsgi_app)
+
 # --- Модели ---
 class Client(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -20,13 +64,23 @@ class Command(db.Model):
     command = db.Column(db.String(256), nullable=False)
     status = db.Column(db.String(32), default='pending')  # pending, sent, done
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    blob_ref = db.relationship('CommandBlobRef', uselist=False, cascade='all, delete-orphan')
+
+    @db.validates('command')
+    def _link_blob(self, key, text):
+        # Ссылка на тело команды хранится отдельно, чтобы не искать хэш в тексте команд
+        digest = command_blob_hash(text)
+        self.blob_ref = CommandBlobRef(hash=digest) if digest else None
+        return text
 
 class ClientData(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'))
     data_type = db.Column(db.String(64))
-    data = db.Column(db.Text)
+    data = db.Column(db.JSON)  # Старые строки хранили тот же JSON как текст - читаются так же
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Сворачивание истории ищет устаревшие строки по типу и времени
+    __table_args__ = (db.Index('ix_client_data_type_created', 'data_type', 'created_at'),)
 
 class PLU(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -88,7 +142,7 @@ class TotalSales(db.Model):
     plu_weight = db.Column(db.Integer, default=0)  # Вес PLU
     free_plu = db.Column(db.Integer, default=0)  # Свободные PLU
     free_msg = db.Column(db.Integer, default=0)  # Свободные сообщения
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
 class ScaleStatus(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -104,63 +158,729 @@ class ScaleStatus(db.Model):
     dual_range = db.Column(db.Boolean, default=False)  # Двойной диапазон
     stable_weight = db.Column(db.Boolean, default=False)  # Стабильный вес
     minus_sign = db.Column(db.Boolean, default=False)  # Минусовый знак
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class WeighingEvent(db.Model):
+    """Законченное взвешивание, выделенное клиентом из опроса статуса (weighing.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'))
+    plu_number = db.Column(db.Integer, default=0)  # Номер PLU
+    weight = db.Column(db.Integer, default=0)  # Вес
+    price = db.Column(db.Integer, default=0)  # Цена
+    sum = db.Column(db.Integer, default=0)  # Сумма
+    duration = db.Column(db.Float, default=0)  # От начала взвешивания до снятия товара (секунды)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)  # Начало взвешивания по часам клиента (UTC)
+    __table_args__ = (db.Index('ix_weighing_event_client_created', 'client_id', 'created_at'),)
+
+class StatusChunk(db.Model):
+    """Показания статуса клиента за CHUNK_SECONDS секунд в сжатом виде (status_series.py)"""
+    client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'), primary_key=True)
+    start = db.Column(db.DateTime, primary_key=True)  # Начало блока
+    end_at = db.Column(db.DateTime)  # Время последнего показания
+    count = db.Column(db.Integer, default=0)  # Принято показаний, включая повторы
+    data = db.Column(db.LargeBinary, default=b'')
+    # Последние значения блока - от них кодируется следующее показание
+    last_status = db.Column(db.Integer, default=0)
+    last_weight = db.Column(db.Integer, default=0)
+    last_price = db.Column(db.Integer, default=0)
+    last_sum = db.Column(db.Integer, default=0)
+    last_plu = db.Column(db.Integer, default=0)
+    # Запись повтора в конце блока: число повторов и ее смещение в data
+    run_count = db.Column(db.Integer, default=0)
+    run_offset = db.Column(db.Integer, default=0)
+
+class ClientCatalog(db.Model):
+    """Какие версии PLU подтверждены весами клиента"""
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'), unique=True)
+    acked = db.Column(db.Text, default='{}')  # JSON {номер PLU: хэш содержимого}
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ClientState(db.Model):
+    """Последнее состояние клиента для главной страницы, обновляется при приеме данных"""
+    client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'), primary_key=True)
+    scales_connected = db.Column(db.Boolean, default=False)
+    connection_attempts = db.Column(db.Integer, default=0)
+    status_at = db.Column(db.DateTime)  # Время последнего scales_status
+    scale_status = db.Column(db.JSON)  # Последний current_status
+    scale_status_at = db.Column(db.DateTime)
+    sales = db.Column(db.JSON)  # Последний total_sales
+    sales_at = db.Column(db.DateTime)
+    command_result = db.Column(db.JSON)  # Результат последней команды
+    command_result_at = db.Column(db.DateTime)
+
+class PLUPush(db.Model):
+    """Содержимое команды upload_plu, ожидающей подтверждения"""
+    command_id = db.Column(db.Integer, db.ForeignKey('command.id'), primary_key=True)
+    client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'))
+    manifest = db.Column(db.Text, nullable=False)  # JSON {номер PLU: хэш содержимого}
+
+class ClientGroup(db.Model):
+    """Группа весов (магазин, отдел) для рассылки каталога одним действием"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    members = db.relationship('ClientGroupMember', backref='group', cascade='all, delete-orphan')
+
+class ClientGroupMember(db.Model):
+    group_id = db.Column(db.Integer, db.ForeignKey('client_group.id'), primary_key=True)
+    client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'), primary_key=True)
+
+class FanOut(db.Model):
+    """Рассылка товаров всем весам группы"""
+    id = db.Column(db.Integer, primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('client_group.id'))
+    group_name = db.Column(db.String(100))
+    full = db.Column(db.Boolean, default=False)
+    numbers = db.Column(db.Text)  # Номера выбранных товаров через запятую, пусто - все
+    total = db.Column(db.Integer, default=0)  # Весов в группе
+    skipped = db.Column(db.Integer, default=0)  # Весов, где все товары уже загружены
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class FanOutCommand(db.Model):
+    command_id = db.Column(db.Integer, db.ForeignKey('command.id'), primary_key=True)
+    fanout_id = db.Column(db.Integer, db.ForeignKey('fan_out.id'), index=True)
+    result = db.Column(db.String(16))  # ok, error; пусто - нет подтверждения
+
+class CommandBlob(db.Model):
+    """Большое тело команды, хранимое один раз на одинаковое содержимое"""
+    hash = db.Column(db.String(64), primary_key=True)  # sha256 содержимого
+    data = db.Column(db.LargeBinary, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class CommandBlobRef(db.Model):
+    """Команда, тело которой хранится в CommandBlob"""
+    command_id = db.Column(db.Integer, db.ForeignKey('command.id'), primary_key=True)
+    hash = db.Column(db.String(64), index=True)
+
+class BatchReceipt(db.Model):
+    """Принятый элемент пакета из очереди клиента - повторная доставка не применяется"""
+    uid = db.Column(db.String(32), primary_key=True)
+    client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class DataRollup(db.Model):
+    """Количество строк ClientData одного типа за час или сутки"""
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'))
+    data_type = db.Column(db.String(64))
+    period = db.Column(db.String(4))  # hour, day
+    start = db.Column(db.DateTime)  # Начало часа или суток
+    samples = db.Column(db.Integer, default=0)
+    __table_args__ = (db.UniqueConstraint('client_id', 'data_type', 'period', 'start'),)
+
+class StatusRollup(db.Model):
+    """Итоги ScaleStatus за час или сутки"""
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'))
+    period = db.Column(db.String(4))  # hour, day
+    start = db.Column(db.DateTime)  # Начало часа или суток
+    samples = db.Column(db.Integer, default=0)
+    weight_min = db.Column(db.Integer)
+    weight_max = db.Column(db.Integer)
+    weight_total = db.Column(db.Integer, default=0)  # Сумма весов для среднего
+    overload_count = db.Column(db.Integer, default=0)
+    stable_count = db.Column(db.Integer, default=0)
+    __table_args__ = (db.UniqueConstraint('client_id', 'period', 'start'),)
+
+    @property
+    def weight_avg(self):
+        return self.weight_total / self.samples if self.samples else 0
+
+class SalesRollup(db.Model):
+    """Первые и последние показания счетчиков TotalSales за час или сутки"""
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.String(64), db.ForeignKey('client.client_id'))
+    period = db.Column(db.String(4))  # hour, day
+    start = db.Column(db.DateTime)  # Начало часа или суток
+    samples = db.Column(db.Integer, default=0)
+    total_sum_first = db.Column(db.Integer)
+    total_sum_last = db.Column(db.Integer)
+    sales_count_first = db.Column(db.Integer)
+    sales_count_last = db.Column(db.Integer)
+    total_weight_first = db.Column(db.Integer)
+    total_weight_last = db.Column(db.Integer)
+    label_count_last = db.Column(db.Integer)
+    mileage_last = db.Column(db.Integer)
+    __table_args__ = (db.UniqueConstraint('client_id', 'period', 'start'),)
+
+# --- Выгрузка PLU в весы ---
+def plu_payload(p):
+    return {
+        'number': p.number,
+        'name1': p.name1,
+        'name2': p.name2,
+        'price': p.price,
+        'code': p.code,
+        'group_code': p.group_code,
+        'tare': p.tare,
+        'message_number': p.message_number,
+        'expiry_type': p.expiry_type,
+        'expiry_value': p.expiry_value,
+        'logo_type': p.logo_type,
+        'cert_code': p.cert_code
+    }
+
+def plu_hash(payload):
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+# --- Большие тела команд ---
+COMMAND_BLOB_THRESHOLD = 4096  # Тела команд больше этого размера (байты) выносятся в CommandBlob
+BLOB_MIN_AGE = timedelta(days=1)  # Неиспользуемое тело удаляется не раньше этого срока
+
+def command_body(text):
+    """Текст для Command.command: большое тело заменяется ссылкой на CommandBlob.
+
+    Одинаковые тела (например, один каталог для многих весов) хранятся один
+    раз, клиент получает их через /api/blobs/<hash>.
+    """
+    data = text.encode('utf-8')
+    if len(data) <= COMMAND_BLOB_THRESHOLD:
+        return text
+    digest = hashlib.sha256(data).hexdigest()
+    if not db.session.get(CommandBlob, digest):
+        db.session.add(CommandBlob(hash=digest, data=data, size=len(data)))
+    return json.dumps({'action': 'blob', 'blob': digest, 'size': len(data)})
+
+def command_blob_hash(text):
+    """Хэш CommandBlob, на который ссылается текст команды, или None"""
+    if not text or not text.startswith('{"action": "blob"'):
+        return None
+    try:
+        return json.loads(text).get('blob')
+    except ValueError:
+        return None
+
+def prune_command_blobs(now):
+    """Удаляет старые тела, на которые не ссылается ни одна невыполненная команда - одним запросом"""
+    in_use = db.exists().where(
+        CommandBlobRef.hash == CommandBlob.hash,
+        Command.id == CommandBlobRef.command_id,
+        Command.status != 'done',
+    )
+    CommandBlob.query.filter(CommandBlob.created_at < now - BLOB_MIN_AGE, ~in_use).delete(synchronize_session=False)
+
+def init_command_blob_refs():
+    """Заполняет CommandBlobRef для невыполненных команд, созданных до появления таблицы"""
+    commands = Command.query.outerjoin(CommandBlobRef).filter(
+        Command.status != 'done', CommandBlobRef.command_id.is_(None), Command.command.startswith('{"action": "blob"')
+    )
+    for command in commands:
+        digest = command_blob_hash(command.command)
+        if digest:
+            db.session.add(CommandBlobRef(command_id=command.id, hash=digest))
+    db.session.commit()
+
+# Записи PLU в формате весов (83 байта), собранные один раз на изменение товара
+_plu_records = {}  # номер PLU -> (хэш содержимого, запись)
+_plu_records_lock = threading.Lock()
+
+def plu_record(payload, digest):
+    with _plu_records_lock:
+        cached = _plu_records.get(payload['number'])
+    if cached and cached[0] == digest:
+        return cached[1]
+    record = encode_plu(scale_plu(payload))
+    with _plu_records_lock:
+        _plu_records[payload['number']] = (digest, record)
+    return record
+
+def invalidate_plu_record(*numbers):
+    with _plu_records_lock:
+        for number in numbers:
+            _plu_records.pop(number, None)
+
+class PLUUploadBuilder:
+    """Команды upload_plu для одного или многих клиентов из одного прохода по каталогу.
+
+    Содержимое, хэши и записи PLU считаются один раз, а клиенты, которым
+    нужен одинаковый набор PLU, получают одно и то же тело команды.
+    """
+    def __init__(self, plus):
+        self.items = []
+        for p in plus:
+            payload = plu_payload(p)
+            self.items.append((str(p.number), payload, plu_hash(payload)))
+        self._bodies = {}  # (full, номера PLU) -> (тело команды, манифест)
+
+    def _body(self, items, full=False):
+        key = (full, tuple(number for number, _, _ in items))
+        if key in self._bodies:
+            return self._bodies[key]
+        records = bytearray()
+        for number, payload, digest in items:
+            try:
+                records += plu_record(payload, digest)
+            except (ValueError, TypeError, KeyError) as e:
+                # Клиент сам соберет записи из data и сообщит, какой PLU не записался
+                print(f"Ошибка сборки записи PLU {number}: {e}")
+                records = None
+                break
+        # data остается для клиентов, которые не знают records
+        command_data = {'action': 'upload_plu', 'data': [payload for _, payload, _ in items]}
+        if full:
+            # Полная отправка пишет записи в весы, даже если они совпадают с копией PLU клиента
+            command_data['refresh'] = True
+        if records is not None:
+            command_data['records'] = base64.b64encode(records).decode('ascii')
+        body = (command_body(json.dumps(command_data)), json.dumps({number: digest for number, _, digest in items}))
+        self._bodies[key] = body
+        return body
+
+    def enqueue(self, client_id, acked, full=False):
+        """Добавляет команду с PLU, которых нет среди acked; None - отправлять нечего"""
+        items = [item for item in self.items if acked.get(item[0]) != item[2]]
+        if not items:
+            return None
+        text, manifest = self._body(items, full)
+        command = Command(client_id=client_id, command=text)
+        db.session.add(command)
+        return command, manifest, len(items)
+
+def enqueue_plu_uploads(client_ids, plus, full=False):
+    """Ставит команды upload_plu сразу многим клиентам, не фиксируя транзакцию.
+
+    Возвращает {client_id: (команда, количество PLU)}; клиентов, в весах
+    которых все уже загружено, в результате нет. full - отправить все PLU
+    заново: без учета подтвержденных и с записью в весы поверх копии клиента.
+    """
+    builder = PLUUploadBuilder(plus)
+    acked = {} if full else {
+        c.client_id: json.loads(c.acked or '{}')
+        for c in ClientCatalog.query.filter(ClientCatalog.client_id.in_(client_ids))
+    }
+    queued = {}
+    for client_id in client_ids:
+        entry = builder.enqueue(client_id, acked.get(client_id, {}), full)
+        if entry:
+            queued[client_id] = entry
+    db.session.flush()
+    db.session.add_all([
+        PLUPush(command_id=command.id, client_id=client_id, manifest=manifest)
+        for client_id, (command, manifest, _) in queued.items()
+    ])
+    return {client_id: (command, count) for client_id, (command, _, count) in queued.items()}
+
+def enqueue_plu_upload(client_id, plus, full=False):
+    """Ставит команду upload_plu только с теми PLU, которых еще нет в весах клиента.
+
+    Возвращает количество PLU в команде (0 - команда не создана).
+    """
+    queued = enqueue_plu_uploads([client_id], plus, full=full)
+    return queued[client_id][1] if client_id in queued else 0
+
+def start_fanout(group, plus, full=False, numbers=''):
+    """Рассылает товары всем весам группы одной транзакцией"""
+    client_ids = [m.client_id for m in group.members]
+    queued = enqueue_plu_uploads(client_ids, plus, full=full)
+    fanout = FanOut(group_id=group.id, group_name=group.name, full=full, numbers=numbers,
+                    total=len(client_ids), skipped=len(client_ids) - len(queued))
+    db.session.add(fanout)
+    db.session.flush()
+    db.session.add_all([FanOutCommand(command_id=command.id, fanout_id=fanout.id)
+                        for command, _ in queued.values()])
+    return fanout, list(queued)
+
+def fanout_progress(fanout):
+    rows = db.session.query(Command.status, FanOutCommand.result, db.func.count()).join(
+        Command, Command.id == FanOutCommand.command_id
+    ).filter(FanOutCommand.fanout_id == fanout.id).group_by(Command.status, FanOutCommand.result).all()
+    progress = {'total': fanout.total, 'skipped': fanout.skipped, 'done': 0, 'failed': 0, 'pending': 0}
+    for status, result, count in rows:
+        if status != 'done':
+            progress['pending'] += count
+        elif result == 'error':
+            progress['failed'] += count
+        else:
+            progress['done'] += count
+    return progress
+
+def apply_fanout_ack(command, content):
+    link = db.session.get(FanOutCommand, command.id)
+    if link:
+        ok = content.get('result', 'ok') == 'ok' and not content.get('failed_plu')
+        link.result = 'ok' if ok else 'error'
+
+def apply_plu_push_ack(command, content):
+    """Переносит PLU подтвержденной команды upload_plu в каталог клиента"""
+    push = db.session.get(PLUPush, command.id)
+    if not push:
+        return
+    if content.get('result', 'ok') == 'ok':
+        manifest = json.loads(push.manifest)
+        for number in content.get('failed_plu') or []:
+            manifest.pop(str(number), None)
+
+        catalog = ClientCatalog.query.filter_by(client_id=command.client_id).first()
+        if not catalog:
+            catalog = ClientCatalog(client_id=command.client_id, acked='{}')
+            db.session.add(catalog)
+        acked = json.loads(catalog.acked or '{}')
+        acked.update(manifest)
+        catalog.acked = json.dumps(acked)
+        catalog.updated_at = datetime.utcnow()
+    db.session.delete(push)
+
+# --- Уведомления о новых командах для длинного опроса ---
+LONG_POLL_MAX = 60  # Максимальное ожидание команды в одном запросе (секунды)
+
+_command_waiters = {}  # client_id -> события ожидающих команду запросов
+_command_waiters_lock = threading.Lock()
+# Каждая постановка команды в очередь вызывает notify_client. Поэтому, если у клиента
+# не было команд и с тех пор уведомлений не было, очередь можно не проверять в БД.
+# Команды, поставленные другим процессом сервера, находит _watch_commands: раз в
+# COMMAND_WATCH_INTERVAL он читает из БД только новые id команд и уведомляет их клиентов.
+COMMAND_WATCH_INTERVAL = 2  # секунды
+_command_notices = {}  # client_id -> счетчик уведомлений о новых командах
+_idle_notices = {}  # client_id -> значение счетчика, при котором команд у клиента не было
+_command_watch = {'thread': None, 'last_id': None}
+
+def notify_client(client_id):
+    """Будит ожидающие запросы клиента после постановки команды в очередь"""
+    with _command_waiters_lock:
+        _command_notices[client_id] = _command_notices.get(client_id, 0) + 1
+        for event in _command_waiters.get(client_id, ()):
+            event.set()
+
+def check_new_commands():
+    """Уведомляет клиентов о командах, появившихся в БД после прошлой проверки"""
+    rows = db.session.query(Command.id, Command.client_id).filter(Command.id > _command_watch['last_id']).all()
+    db.session.close()
+    for command_id, client_id in rows:
+        notify_client(client_id)
+        _command_watch['last_id'] = max(_command_watch['last_id'], command_id)
+
+def _watch_commands():
+    while True:
+        time.sleep(COMMAND_WATCH_INTERVAL)
+        try:
+            with app.app_context():
+                check_new_commands()
+        except Exception as e:
+            print(f"Ошибка проверки новых команд: {e}")
+
+def start_command_watch():
+    with _command_waiters_lock:
+        if _command_watch['thread'] is None:
+            # Отсчет до первого чтения очереди ожидающими: более ранние команды они найдут сами
+            _command_watch['last_id'] = db.session.query(db.func.max(Command.id)).scalar() or 0
+            _command_watch['thread'] = threading.Thread(target=_watch_commands, name='command-watch', daemon=True)
+            _command_watch['thread'].start()
+
+# --- Присутствие клиентов ---
+# Время последнего опроса копится в памяти и записывается в Client.last_seen
+# одним запросом не чаще раза в PRESENCE_FLUSH_INTERVAL: пустой опрос не пишет в БД.
+PRESENCE_FLUSH_INTERVAL = 30  # секунды
+
+_known_clients = None  # client_id зарегистрированных клиентов, читается из БД один раз и дополняется
+_presence = {}  # client_id -> время последнего обращения, еще не записанное в БД
+_presence_lock = threading.Lock()
+_presence_flushed_at = time.monotonic()
+
+def known_clients():
+    global _known_clients
+    if _known_clients is None:
+        client_ids = {row[0] for row in db.session.query(Client.client_id)}
+        with _presence_lock:
+            if _known_clients is None:
+                _known_clients = client_ids
+    return _known_clients
+
+def client_exists(client_id):
+    known = known_clients()
+    if client_id in known:
+        return True
+    # Клиента мог зарегистрировать другой процесс сервера
+    if db.session.query(Client.client_id).filter_by(client_id=client_id).first():
+        known.add(client_id)
+        return True
+    return False
+
+def flush_presence(force=False):
+    """Записывает накопленное время обращений клиентов; force - не ждать интервала"""
+    global _presence_flushed_at
+    with _presence_lock:
+        if not _presence or not force and time.monotonic() - _presence_flushed_at < PRESENCE_FLUSH_INTERVAL:
+            return
+        rows = [{'cid': client_id, 'seen': seen} for client_id, seen in _presence.items()]
+        _presence.clear()
+        _presence_flushed_at = time.monotonic()
+    db.session.execute(
+        Client.__table__.update().where(Client.client_id == db.bindparam('cid')).values(last_seen=db.bindparam('seen')),
+        rows,
+    )
+    db.session.commit()
+
+def touch_clients(client_ids):
+    """Регистрирует новых клиентов и отмечает время последнего обращения"""
+    now = datetime.utcnow()
+    known = known_clients()
+    new = [client_id for client_id in client_ids if client_id not in known]
+    if new:
+        # Новый клиент записывается сразу: на него ссылаются остальные таблицы
+        existing = {row[0] for row in db.session.query(Client.client_id).filter(Client.client_id.in_(new))}
+        db.session.add_all([Client(client_id=client_id, last_seen=now) for client_id in new
+                            if client_id not in existing])
+        db.session.commit()
+        known.update(new)
+    with _presence_lock:
+        for client_id in client_ids:
+            _presence[client_id] = now
+    flush_presence()
+
+def wait_for_commands(client_ids, wait):
+    """Ждет до wait секунд, пока у кого-то из клиентов появится команда.
+
+    Возвращает по одной самой старой ожидающей команде на клиента, уже
+    отмеченной как отправленная, или пустой список по истечении ожидания.
+    """
+    start_command_watch()
+    event = threading.Event()
+    with _command_waiters_lock:
+        for client_id in client_ids:
+            _command_waiters.setdefault(client_id, set()).add(event)
+    try:
+        deadline = time.monotonic() + wait
+        while True:
+            event.clear()
+            with _command_waiters_lock:
+                notices = {client_id: _command_notices.get(client_id, 0) for client_id in client_ids}
+            unknown = [client_id for client_id in client_ids if _idle_notices.get(client_id) != notices[client_id]]
+            if unknown:
+                pending = Command.query.filter(
+                    Command.client_id.in_(unknown), Command.status == 'pending'
+                ).order_by(Command.id).all()
+                commands = {}
+                for command in pending:
+                    commands.setdefault(command.client_id, command)
+                with _command_waiters_lock:
+                    for client_id in unknown:
+                        if client_id not in commands and _command_notices.get(client_id, 0) == notices[client_id]:
+                            _idle_notices[client_id] = notices[client_id]
+                if commands:
+                    result = []
+                    for command in commands.values():
+                        command.status = 'sent'
+                        result.append({'client_id': command.client_id, 'command': command.command,
+                                       'command_id': command.id})
+                    db.session.commit()
+                    return result
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            # Соединение с БД не держим, пока ждем уведомления
+            db.session.close()
+            event.wait(remaining)
+    finally:
+        with _command_waiters_lock:
+            for client_id in client_ids:
+                waiters = _command_waiters.get(client_id)
+                waiters.discard(event)
+                if not waiters:
+                    del _command_waiters[client_id]
+
+def _long_poll_wait():
+    return min(max(request.args.get('wait', 0, type=float), 0), LONG_POLL_MAX)
 
 # --- API ---
 @app.route('/api/commands/<client_id>', methods=['GET'])
 def get_command(client_id):
-    client = Client.query.filter_by(client_id=client_id).first()
-    if not client:
-        client = Client(client_id=client_id)
-        db.session.add(client)
-        db.session.commit()
-    client.last_seen = datetime.utcnow()
+    touch_clients([client_id])
+    wait = _long_poll_wait()
+    commands = wait_for_commands([client_id], wait)
+    if commands:
+        return jsonify({'command': commands[0]['command'], 'command_id': commands[0]['command_id']})
+    return jsonify({'command': None, 'wait': wait})
+
+@app.route('/api/commands', methods=['GET'])
+def get_commands_multi():
+    """Опрос команд сразу для всех весов одного клиентского процесса: ?clients=id1,id2"""
+    client_ids = list(dict.fromkeys(c for c in request.args.get('clients', '').split(',') if c))
+    if not client_ids:
+        return jsonify({'error': 'No clients'}), 400
+    touch_clients(client_ids)
+    wait = _long_poll_wait()
+    return jsonify({'commands': wait_for_commands(client_ids, wait), 'wait': wait})
+
+@app.route('/api/blobs/<digest>', methods=['GET'])
+def get_blob(digest):
+    """Тело команды по хэшу; содержимое неизменно, поэтому его можно кэшировать и докачивать"""
+    blob = db.session.get(CommandBlob, digest)
+    if not blob:
+        abort(404)
+    response = Response(blob.data, mimetype='application/json')
+    response.set_etag(digest)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response.make_conditional(request, accept_ranges=True, complete_length=blob.size)
+
+# --- История статуса весов ---
+def _status_chunks():
+    """Открытые в этой сессии блоки статуса: (client_id, начало) -> StatusChunk"""
+    return db.session.info.setdefault('status_chunks', {})
+
+def append_status(client_id, at, status_data):
+    """Дописывает показание статуса в блок клиента.
+
+    Повтор предыдущего показания только продлевает запись повтора в конце
+    блока; в этом случае возвращается False.
+    """
+    start = chunk_start(at)
+    chunks = _status_chunks()
+    chunk = chunks.get((client_id, start))
+    if chunk is None:
+        with db.session.no_autoflush:
+            chunk = db.session.get(StatusChunk, (client_id, start))
+        if chunk is None:
+            chunk = StatusChunk(client_id=client_id, start=start, end_at=start, count=0, data=b'', last_status=0,
+                                last_weight=0, last_price=0, last_sum=0, last_plu=0, run_count=0, run_offset=0)
+            db.session.add(chunk)
+        chunks[(client_id, start)] = chunk
+    reading = (to_ms(at), status_data.get('status_byte', 0), status_data.get('weight', 0),
+               status_data.get('price', 0), status_data.get('sum', 0), status_data.get('plu_number', 0))
+    last = (chunk.last_weight, chunk.last_price, chunk.last_sum, chunk.last_plu)
+    prev_ms = to_ms(chunk.end_at)
+    ms = max(reading[0], prev_ms)
+    chunk.count += 1
+    chunk.end_at = from_ms(ms)
+    if chunk.count > 1 and reading[1:] == (chunk.last_status, *last):
+        data = chunk.data[:chunk.run_offset] if chunk.run_count else chunk.data
+        chunk.run_offset = len(data)
+        chunk.run_count += 1
+        chunk.data = data + encode_run(ms, to_ms(start), chunk.run_count)
+        return False
+    chunk.data = chunk.data + encode_readings([reading], prev_ms, last)
+    chunk.last_status, chunk.last_weight, chunk.last_price, chunk.last_sum, chunk.last_plu = reading[1:]
+    chunk.run_count = 0
+    return True
+
+def chunk_readings(chunk):
+    for ms, last_ms, count, *values in decode_readings(chunk.data, to_ms(chunk.start)):
+        yield StatusReading(chunk.client_id, from_ms(ms), *values, last_at=from_ms(last_ms), count=count)
+
+def status_range(client_id, start, end):
+    """Показания статуса клиента с start по end по порядку, серии повторов - одним значением"""
+    chunks = StatusChunk.query.filter(
+        StatusChunk.client_id == client_id,
+        StatusChunk.start > start - timedelta(seconds=CHUNK_SECONDS),
+        StatusChunk.start <= end,
+    ).order_by(StatusChunk.start)
+    return [r for chunk in chunks for r in chunk_readings(chunk) if r.last_at >= start and r.created_at <= end]
+
+# Писать ли каждое новое показание current_status еще и строкой ClientData (страница данных клиента).
+# История статуса и без этого хранится в StatusChunk, поэтому по умолчанию выключено.
+RAW_STATUS_FEED = False
+
+# Данные, последнее значение которых хранится в ClientState
+CLIENT_STATE_TYPES = ('scales_status', 'current_status', 'total_sales', 'command_result')
+
+def update_client_state(client_id, data_type, data, at):
+    if data_type not in CLIENT_STATE_TYPES:
+        return
+    state = db.session.get(ClientState, client_id)
+    if state is None:
+        state = ClientState(client_id=client_id)
+        db.session.add(state)
+    if data_type == 'scales_status':
+        status_data = data if isinstance(data, dict) else {}
+        state.scales_connected = status_data.get('scales_connected', False)
+        state.connection_attempts = status_data.get('connection_attempts', 0)
+        state.status_at = at
+    elif data_type == 'current_status':
+        state.scale_status, state.scale_status_at = data, at
+    elif data_type == 'total_sales':
+        state.sales, state.sales_at = data, at
+    elif data_type == 'command_result':
+        state.command_result, state.command_result_at = data, at
+
+def init_indexes():
+    """Создает индексы моделей на таблицах, созданных до их появления (create_all их не добавляет)"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            columns = ', '.join(column.name for column in index.columns)
+            unique = 'UNIQUE ' if index.unique else ''
+            db.session.execute(db.text(f'CREATE {unique}INDEX IF NOT EXISTS {index.name} ON {table.name} ({columns})'))
     db.session.commit()
-    command = Command.query.filter_by(client_id=client_id, status='pending').first()
-    if command:
-        command.status = 'sent'
-        db.session.commit()
-        return jsonify({'command': command.command, 'command_id': command.id})
-    return jsonify({'command': None})
 
-@app.route('/api/data/<client_id>', methods=['POST'])
-def post_data(client_id):
-    content = request.json
+def init_client_state():
+    """Заполняет ClientState из истории ClientData для клиентов, у которых его еще нет"""
+    missing = db.session.query(Client.client_id).outerjoin(
+        ClientState, ClientState.client_id == Client.client_id
+    ).filter(ClientState.client_id.is_(None))
+    latest = db.session.query(db.func.max(ClientData.id)).filter(
+        ClientData.client_id.in_(missing), ClientData.data_type.in_(CLIENT_STATE_TYPES)
+    ).group_by(ClientData.client_id, ClientData.data_type)
+    for row in ClientData.query.filter(ClientData.id.in_(latest)).order_by(ClientData.id):
+        update_client_state(row.client_id, row.data_type, row.data, row.created_at)
+    db.session.commit()
+
+def decode_client_data(data):
+    """Данные клиента как объект JSON.
+
+    Новые клиенты присылают data объектом, старые - строкой с JSON внутри;
+    строка, которая не является JSON, хранится как есть.
+    """
+    if isinstance(data, str):
+        try:
+            return json.loads(data)
+        except ValueError:
+            return data
+    return data
+
+# Обработчики принимаемых от клиента данных. Изменения только добавляются
+# в сессию, фиксирует их вызывающий эндпоинт - отдельный или пакетный.
+def add_weighings(client_id, events, received_at):
+    for event in events:
+        try:
+            created_at = datetime.fromisoformat(event['at']) if event.get('at') else received_at
+        except (TypeError, ValueError):
+            created_at = received_at
+        db.session.add(WeighingEvent(
+            client_id=client_id,
+            plu_number=event.get('plu_number', 0),
+            weight=event.get('weight', 0),
+            price=event.get('price', 0),
+            sum=event.get('sum', 0),
+            duration=event.get('duration', 0),
+            created_at=created_at,
+        ))
+
+def apply_client_data(client_id, content, received_at=None):
     data_type = content.get('data_type')
-    data = content.get('data')
-    client = Client.query.filter_by(client_id=client_id).first()
-    if not client:
-        return jsonify({'error': 'Unknown client'}), 404
-    
-    # Сохраняем данные в ClientData
-    client_data = ClientData(client_id=client_id, data_type=data_type, data=data)
-    db.session.add(client_data)
-    
-    # Обрабатываем специальные типы данных
+    data = decode_client_data(content.get('data'))
+    received_at = received_at or datetime.utcnow()
+
+    if data_type == 'weighings':
+        # Взвешивания хранятся только в своей таблице, копия в ClientData не нужна
+        try:
+            add_weighings(client_id, data.get('events', []), received_at)
+        except Exception as e:
+            print(f"Ошибка обработки взвешиваний: {e}")
+        return
+
     if data_type == 'current_status':
+        # История статуса хранится в блоках StatusChunk, последнее показание - в ClientState
         try:
-            status_data = json.loads(data)
-            scale_status = ScaleStatus(
-                client_id=client_id,
-                status_byte=status_data.get('status_byte', 0),
-                weight=status_data.get('weight', 0),
-                price=status_data.get('price', 0),
-                sum=status_data.get('sum', 0),
-                plu_number=status_data.get('plu_number', 0),
-                overload=status_data.get('bits', {}).get('overload', False),
-                tare_mode=status_data.get('bits', {}).get('tare_mode', False),
-                zero_weight=status_data.get('bits', {}).get('zero_weight', False),
-                dual_range=status_data.get('bits', {}).get('dual_range', False),
-                stable_weight=status_data.get('bits', {}).get('stable_weight', False),
-                minus_sign=status_data.get('bits', {}).get('minus_sign', False)
-            )
-            db.session.add(scale_status)
+            appended = append_status(client_id, received_at, data)
+            update_client_state(client_id, data_type, data, received_at)
+            if not (appended and RAW_STATUS_FEED):
+                return
         except Exception as e:
+            # Показание не потеряется: оно останется строкой ClientData
             print(f"Ошибка обработки статуса: {e}")
+
+    # Сохраняем данные в ClientData
+    client_data = ClientData(client_id=client_id, data_type=data_type, data=data, created_at=received_at)
+    db.session.add(client_data)
+    update_client_state(client_id, data_type, data, received_at)
     
-    elif data_type == 'total_sales':
+    # Обрабатываем специальные типы данных
+    if data_type == 'total_sales':
         try:
-            sales_data = json.loads(data)
+            sales_data = data
             total_sales = TotalSales(
                 client_id=client_id,
                 mileage=sales_data.get('mileage', 0),
@@ -172,22 +892,501 @@ def post_data(client_id):
                 plu_sales_count=sales_data.get('plu_sales_count', 0),
                 plu_weight=sales_data.get('plu_weight', 0),
                 free_plu=sales_data.get('free_plu', 0),
-                free_msg=sales_data.get('free_msg', 0)
+                free_msg=sales_data.get('free_msg', 0),
+                created_at=received_at
             )
             db.session.add(total_sales)
         except Exception as e:
             print(f"Ошибка обработки продаж: {e}")
+
+def apply_command_ack(client_id, content):
+    """Отмечает команду выполненной, False - если такой команды нет"""
+    command_id = content.get('command_id')
+    command = Command.query.filter_by(id=command_id, client_id=client_id).first()
+    if not command:
+        return False
+    command.status = 'done'
+    apply_plu_push_ack(command, content)
+    apply_fanout_ack(command, content)
+    return True
+
+UPSERT_CHUNK = 500  # Ключей в одном запросе IN и строк в одном executemany
+
+def bulk_upsert(model, key, rows):
+    """Добавляет и обновляет строки model по столбцу key без загрузки объектов ORM.
+
+    rows - словари со значением key и обновляемых столбцов. Существующие
+    строки читаются запросами IN порциями, неизмененные пропускаются,
+    остальные пишутся одним executemany на порцию. Возвращает количество
+    добавленных, обновленных и неизмененных строк и ключи измененных.
+    """
+    table = model.__table__
+    unique = {}
+    for row in rows:
+        unique[row[key]] = row  # Повтор ключа - побеждает последняя строка
+    if not unique:
+        return {'inserted': 0, 'updated': 0, 'unchanged': 0}, []
+    fields = [name for name in next(iter(unique.values())) if name != key]
+    columns = [table.c[name] for name in fields]
+    update = table.update().where(table.c[key] == db.bindparam('_key')).values(
+        {name: db.bindparam(f'_{name}') for name in fields}
+    )
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    changed = []
+    keys = list(unique)
+    for i in range(0, len(keys), UPSERT_CHUNK):
+        chunk = keys[i:i + UPSERT_CHUNK]
+        existing = {
+            r[0]: tuple(r[1:])
+            for r in db.session.execute(db.select(table.c[key], *columns).where(table.c[key].in_(chunk)))
+        }
+        inserts, updates = [], []
+        for k in chunk:
+            row = unique[k]
+            values = tuple(row[name] for name in fields)
+            if k not in existing:
+                inserts.append(row)
+            elif existing[k] != values:
+                updates.append({'_key': k, **{f'_{name}': row[name] for name in fields}})
+            else:
+                counts['unchanged'] += 1
+                continue
+            changed.append(k)
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+        if updates:
+            db.session.execute(update, updates)
+        counts['inserted'] += len(inserts)
+        counts['updated'] += len(updates)
+    return counts, changed
+
+def apply_plu_upload(client_id, content):
+    rows = []
+    for plu in content.get('plu_list', []):
+        if plu.get('number') and plu.get('name1', '') and plu.get('price') is not None:
+            rows.append({
+                'number': plu['number'],
+                'name1': plu['name1'],
+                'name2': plu.get('name2', ''),
+                'price': plu['price'],
+                'code': plu.get('code', '000000'),
+                'group_code': plu.get('group_code', '000000'),
+                'tare': plu.get('tare', 0),
+                'message_number': plu.get('message_number', 0),
+                'expiry_type': plu.get('expiry_type', 0),
+                'expiry_value': plu.get('expiry_value', '01.01.25'),
+                'logo_type': plu.get('logo_type', 0),
+                'cert_code': plu.get('cert_code', ''),
+            })
+    counts, changed = bulk_upsert(PLU, 'number', rows)
+    invalidate_plu_record(*changed)
+    return counts
+
+def apply_message_upload(client_id, content):
+    rows = [
+        {'number': msg.get('id'), 'content': msg.get('content', '')}
+        for msg in content.get('message_list', [])
+        if msg.get('id') and msg.get('content', '')
+    ]
+    return bulk_upsert(Message, 'number', rows)[0]
+
+def apply_settings_upload(client_id, content):
+    settings_type = content.get('settings_type')
+    settings_data = content.get('settings_data', {})
+    
+    if settings_type == 'user':
+        row = {
+            'client_id': client_id,
+            'dept_no': settings_data.get('dept_no', 1),
+            'label_format': settings_data.get('label_format', 0),
+            'barcode_format': settings_data.get('barcode_format', 0),
+            'adjst': settings_data.get('adjst', 0),
+            'print_features': settings_data.get('print_features', 0),
+            'auto_print_weight': settings_data.get('auto_print_weight', 0),
+        }
+        return bulk_upsert(UserSettings, 'client_id', [row])[0]
     
+    elif settings_type == 'factory':
+        row = {
+            'client_id': client_id,
+            'max_weight': settings_data.get('max_weight', 15000),
+            'dec_point_weight': settings_data.get('dec_point_weight', 2),
+            'dec_point_price': settings_data.get('dec_point_price', 2),
+            'dec_point_sum': settings_data.get('dec_point_sum', 2),
+            'dual_range': settings_data.get('dual_range', 0),
+            'weight_step_upper': settings_data.get('weight_step_upper', 10),
+            'weight_step_lower': settings_data.get('weight_step_lower', 5),
+            'price_weight': settings_data.get('price_weight', 0),
+            'round_sum': settings_data.get('round_sum', 0),
+            'tare_limit': settings_data.get('tare_limit', 5000),
+        }
+        return bulk_upsert(FactorySettings, 'client_id', [row])[0]
+
+RECEIPT_TTL = timedelta(days=7)  # Сколько помнить принятые элементы пакетов
+_pruned_at = None
+
+def prune_stale_rows():
+    """Удаляет старые отметки о принятых элементах и тела выполненных команд, не чаще раза в час"""
+    global _pruned_at
+    now = datetime.utcnow()
+    if _pruned_at and now - _pruned_at < timedelta(hours=1):
+        return
+    _pruned_at = now
+    BatchReceipt.query.filter(BatchReceipt.created_at < now - RECEIPT_TTL).delete()
+    prune_command_blobs(now)
+
+# --- Сроки хранения истории ---
+# Строки старше срока сворачиваются в почасовые и суточные итоги и удаляются
+# фоновым потоком порциями по COMPACT_CHUNK строк, каждая в своей короткой
+# транзакции, чтобы не задерживать запись от клиентов. None - хранить всегда.
+CLIENT_DATA_RETENTION_DAYS = {  # ClientData по data_type
+    'scales_status': 7,
+    'current_status': 7,
+    'total_sales': 30,
+    'command_result': 90,
+}
+SCALE_STATUS_RETENTION_DAYS = 30
+STATUS_SERIES_RETENTION_DAYS = 30  # Блоки StatusChunk
+TOTAL_SALES_RETENTION_DAYS = 365
+HOURLY_ROLLUP_RETENTION_DAYS = 90  # Суточные итоги хранятся всегда
+COMPACT_CHUNK = 1000  # Строк в одной транзакции
+COMPACT_PAUSE = 0.5  # Пауза между порциями (секунды)
+COMPACT_INTERVAL = 3600  # Проверка, когда сворачивать нечего (секунды)
+
+def _period_start(at, period):
+    if period == 'hour':
+        return at.replace(minute=0, second=0, microsecond=0)
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _add_data_rollup(rollup, row):
+    rollup.samples += 1
+
+def _add_status_rollup(rollup, row):
+    weight = row.weight or 0
+    count = getattr(row, 'count', 1)  # Серия повторов из StatusChunk - одно значение
+    rollup.weight_min = weight if rollup.weight_min is None else min(rollup.weight_min, weight)
+    rollup.weight_max = weight if rollup.weight_max is None else max(rollup.weight_max, weight)
+    rollup.weight_total = (rollup.weight_total or 0) + weight * count
+    rollup.overload_count = (rollup.overload_count or 0) + (count if row.overload else 0)
+    rollup.stable_count = (rollup.stable_count or 0) + (count if row.stable_weight else 0)
+    rollup.samples += count
+
+def _add_sales_rollup(rollup, row):
+    if not rollup.samples:
+        rollup.total_sum_first = row.total_sum
+        rollup.sales_count_first = row.sales_count
+        rollup.total_weight_first = row.total_weight
+    rollup.total_sum_last = row.total_sum
+    rollup.sales_count_last = row.sales_count
+    rollup.total_weight_last = row.total_weight
+    rollup.label_count_last = row.label_count
+    rollup.mileage_last = row.mileage
+    rollup.samples += 1
+
+def _retention_sources(now):
+    """(модель, запрос устаревших строк, модель итогов, поля ключа, функция добавления строки)"""
+    for data_type, days in CLIENT_DATA_RETENTION_DAYS.items():
+        if days is not None:
+            query = ClientData.query.filter(ClientData.data_type == data_type,
+                                            ClientData.created_at < now - timedelta(days=days))
+            yield ClientData, query, DataRollup, ('client_id', 'data_type'), _add_data_rollup
+    if SCALE_STATUS_RETENTION_DAYS is not None:
+        query = ScaleStatus.query.filter(ScaleStatus.created_at < now - timedelta(days=SCALE_STATUS_RETENTION_DAYS))
+        yield ScaleStatus, query, StatusRollup, ('client_id',), _add_status_rollup
+    if TOTAL_SALES_RETENTION_DAYS is not None:
+        query = TotalSales.query.filter(TotalSales.created_at < now - timedelta(days=TOTAL_SALES_RETENTION_DAYS))
+        yield TotalSales, query, SalesRollup, ('client_id',), _add_sales_rollup
+
+def _rollup_rows(rows, rollup_model, key_fields, add):
+    key_names = key_fields + ('period', 'start')
+    # Итоги, которые могут пересекаться с порцией, читаются одним запросом
+    first = _period_start(min(row.created_at for row in rows), 'day')
+    last = max(row.created_at for row in rows)
+    rollups = {
+        tuple(getattr(rollup, name) for name in key_names): rollup
+        for rollup in rollup_model.query.filter(rollup_model.start >= first, rollup_model.start <= last)
+    }
+    for row in rows:
+        for period in ('hour', 'day'):
+            key = tuple(getattr(row, name) for name in key_fields) + (period, _period_start(row.created_at, period))
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = rollup_model(samples=0, **dict(zip(key_names, key)))
+                db.session.add(rollup)
+                rollups[key] = rollup
+            add(rollup, row)
+
+def _compact_status_chunks(now):
+    if STATUS_SERIES_RETENTION_DAYS is None:
+        return 0
+    # Блок при опросе раз в секунду - до CHUNK_SECONDS показаний
+    cutoff = now - timedelta(days=STATUS_SERIES_RETENTION_DAYS, seconds=CHUNK_SECONDS)
+    chunks = StatusChunk.query.filter(StatusChunk.start < cutoff).order_by(StatusChunk.start).limit(max(COMPACT_CHUNK // CHUNK_SECONDS, 1)).all()
+    if not chunks:
+        return 0
+    readings = [reading for chunk in chunks for reading in chunk_readings(chunk)]
+    if readings:
+        with db.session.no_autoflush:
+            _rollup_rows(readings, StatusRollup, ('client_id',), _add_status_rollup)
+    for chunk in chunks:
+        db.session.delete(chunk)
+    db.session.commit()
+    return max(len(readings), len(chunks))
+
+def compact_step(now=None):
+    """Сворачивает и удаляет одну порцию устаревших строк, возвращает их количество"""
+    now = now or datetime.utcnow()
+    done = _compact_status_chunks(now)
+    if done:
+        return done
+    for model, query, rollup_model, key_fields, add in _retention_sources(now):
+        rows = query.order_by(model.id).limit(COMPACT_CHUNK).all()
+        if not rows:
+            continue
+        with db.session.no_autoflush:
+            _rollup_rows(rows, rollup_model, key_fields, add)
+        db.session.flush()
+        model.query.filter(model.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+        return len(rows)
+    hourly_cutoff = now - timedelta(days=HOURLY_ROLLUP_RETENTION_DAYS)
+    for rollup_model in (DataRollup, StatusRollup, SalesRollup):
+        rollup_model.query.filter(rollup_model.period == 'hour', rollup_model.start < hourly_cutoff).delete()
     db.session.commit()
+    return 0
+
+def _compaction_loop():
+    while True:
+        try:
+            with app.app_context():
+                done = compact_step()
+        except Exception as e:
+            print(f"Ошибка сворачивания истории: {e}")
+            done = 0
+        time.sleep(COMPACT_PAUSE if done else COMPACT_INTERVAL)
+
+def start_compaction():
+    threading.Thread(target=_compaction_loop, name='compaction', daemon=True).start()
+
+@app.cli.command('compact')
+@click.option('--vacuum', is_flag=True, help='Уменьшить файл базы после удаления')
+def compact_command(vacuum):
+    """Сворачивает и удаляет всю историю старше сроков хранения"""
+    total = 0
+    while True:
+        done = compact_step()
+        if not done:
+            break
+        total += done
+    print(f"Свернуто и удалено строк: {total}")
+    if vacuum:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('VACUUM')
+        print("Файл базы уменьшен")
+
+BATCH_HANDLERS = {
+    'data': apply_client_data,
+    'plu_upload': apply_plu_upload,
+    'message_upload': apply_message_upload,
+    'settings_upload': apply_settings_upload,
+}
+
+# --- Фоновая запись данных от клиентов ---
+INGEST_QUEUE_SIZE = 5000  # Запросов в очереди; дальше клиенты получают 503
+INGEST_FLUSH_ROWS = 500  # Строк в одной транзакции
+INGEST_FLUSH_INTERVAL = 0.2  # Наибольшее ожидание набора строк (секунды)
+INGEST_RETRY_AFTER = 1  # Через сколько секунд повторить запрос при полной очереди
+INGEST_ACK_TIMEOUT = 5  # Сколько запрос ждет записи своих данных (секунды)
+
+class IngestWriter:
+    """Пишет принятые данные клиентов в БД из одного фонового потока.
+
+    Запрос только проверяет данные и ставит их в очередь, поток собирает
+    до INGEST_FLUSH_ROWS строк или ждет не дольше INGEST_FLUSH_INTERVAL и
+    фиксирует их одной транзакцией: клиенты не ждут друг друга на
+    блокировке записи SQLite. Запрос получает Future и отвечает клиенту
+    только после фиксации, поэтому очередь клиента не удаляет данные,
+    которые сервер потерял при перезапуске или не смог записать. Элементы
+    с uid, уже записанные раньше, пропускаются, как в /api/batch.
+    """
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'accepted': 0, 'rejected': 0, 'written': 0, 'duplicates': 0, 'dropped': 0,
+                      'flushes': 0, 'last_flush_rows': 0, 'last_flush_ms': 0, 'max_flush_ms': 0,
+                      'last_delay_ms': 0, 'max_delay_ms': 0}
+
+    def submit(self, client_id, items):
+        """Ставит элементы в очередь; None - очередь заполнена.
+
+        Возвращает Future: True - элементы записаны (или уже были записаны
+        раньше), False - запись не удалась.
+        """
+        self.start()
+        future = Future()
+        try:
+            self._queue.put_nowait((client_id, items, datetime.utcnow(), time.monotonic(), future))
+        except queue.Full:
+            with self._lock:
+                self.stats['rejected'] += 1
+            return None
+        with self._lock:
+            self.stats['accepted'] += len(items)
+        return future
+
+    def wait(self, future):
+        """Ждет записи элементов запроса, True - записаны"""
+        try:
+            return future.result(timeout=INGEST_ACK_TIMEOUT)
+        except FutureTimeoutError:
+            return False
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, queue_depth=self._queue.qsize(), queue_limit=INGEST_QUEUE_SIZE)
+
+    def _write(self, groups):
+        uids = [item['uid'] for _, items, _, _, _ in groups for item in items if item.get('uid')]
+        seen = {r.uid for r in BatchReceipt.query.filter(BatchReceipt.uid.in_(uids))} if uids else set()
+        # Состояния клиентов читаются одним запросом, дальше session.get берет их из сессии
+        client_ids = {client_id for client_id, _, _, _, _ in groups}
+        chunks = _status_chunks()
+        chunks.clear()
+        oldest = chunk_start(min(received_at for _, _, received_at, _, _ in groups))
+        for chunk in StatusChunk.query.filter(StatusChunk.client_id.in_(client_ids), StatusChunk.start >= oldest):
+            chunks[(chunk.client_id, chunk.start)] = chunk
+        states = {state.client_id: state for state in ClientState.query.filter(ClientState.client_id.in_(client_ids))}
+        for client_id in client_ids - set(states):
+            states[client_id] = ClientState(client_id=client_id)
+            db.session.add(states[client_id])
+        db.session.flush()
+        written = duplicates = 0
+        for client_id, items, received_at, _, _ in groups:
+            for item in items:
+                uid = item.get('uid')
+                if uid in seen:
+                    duplicates += 1
+                    continue
+                if uid:
+                    seen.add(uid)
+                    db.session.add(BatchReceipt(uid=uid, client_id=client_id))
+                apply_client_data(client_id, item, received_at)
+                written += 1
+        db.session.commit()
+        return written, duplicates
+
+    def _flush(self, groups):
+        started = time.monotonic()
+        rows = sum(len(items) for _, items, _, _, _ in groups)
+        written = duplicates = dropped = 0
+        with app.app_context():
+            try:
+                written, duplicates = self._write(groups)
+                for group in groups:
+                    group[4].set_result(True)
+            except Exception as e:
+                # Одна ошибочная запись не должна мешать остальным - пишем по запросам
+                db.session.rollback()
+                print(f"Ошибка записи данных клиентов: {e}, запись по отдельности")
+                for group in groups:
+                    try:
+                        w, d = self._write([group])
+                        written += w
+                        duplicates += d
+                        group[4].set_result(True)
+                    except Exception as e:
+                        db.session.rollback()
+                        # Клиент получит ошибку и повторит отправку позже
+                        dropped += len(group[1])
+                        group[4].set_result(False)
+                        print(f"Данные клиента {group[0]} не записаны: {e}")
+        finished = time.monotonic()
+        with self._lock:
+            stats = self.stats
+            stats['written'] += written
+            stats['duplicates'] += duplicates
+            stats['dropped'] += dropped
+            stats['flushes'] += 1
+            stats['last_flush_rows'] = rows
+            stats['last_flush_ms'] = round((finished - started) * 1000, 1)
+            stats['max_flush_ms'] = max(stats['max_flush_ms'], stats['last_flush_ms'])
+            # Сколько ждала самая старая строка от приема до записи
+            stats['last_delay_ms'] = round((finished - groups[0][3]) * 1000, 1)
+            stats['max_delay_ms'] = max(stats['max_delay_ms'], stats['last_delay_ms'])
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                group = self._queue.get(timeout=INGEST_FLUSH_INTERVAL)
+            except queue.Empty:
+                continue
+            groups = [group]
+            rows = len(group[1])
+            deadline = time.monotonic() + INGEST_FLUSH_INTERVAL
+            while rows < INGEST_FLUSH_ROWS:
+                remaining = deadline - time.monotonic()
+                try:
+                    group = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                groups.append(group)
+                rows += len(group[1])
+            self._flush(groups)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='ingest', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Дописывает очередь и останавливает поток"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+ingest = IngestWriter()
+
+def _ingest_busy(error='Ingest queue is full'):
+    response = jsonify({'error': error})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(INGEST_RETRY_AFTER)
+    return response
+
+def _ingest(client_id, items):
+    """Пишет элементы через фоновый поток; None - записаны, иначе ответ с ошибкой"""
+    future = ingest.submit(client_id, items)
+    if future is None:
+        return _ingest_busy()
+    if not ingest.wait(future):
+        # Клиент повторит отправку; уже записанные элементы с uid сервер пропустит
+        return _ingest_busy('Data not written')
+    return None
+
+@app.route('/api/data/<client_id>', methods=['POST'])
+def post_data(client_id):
+    if not client_exists(client_id):
+        return jsonify({'error': 'Unknown client'}), 404
+    content = request.get_json(silent=True)
+    if not isinstance(content, dict) or not content.get('data_type'):
+        return jsonify({'error': 'data_type is required'}), 400
+    error = _ingest(client_id, [content])
+    if error:
+        return error
     return jsonify({'status': 'ok'})
 
+@app.route('/api/ingest/metrics', methods=['GET'])
+def ingest_metrics():
+    return jsonify(ingest.metrics())
+
 @app.route('/api/ack/<client_id>', methods=['POST'])
 def ack_command(client_id):
-    content = request.json
-    command_id = content.get('command_id')
-    command = Command.query.filter_by(id=command_id, client_id=client_id).first()
-    if command:
-        command.status = 'done'
+    if apply_command_ack(client_id, request.json):
+        prune_stale_rows()
         db.session.commit()
         return jsonify({'status': 'acknowledged'})
     return jsonify({'error': 'Command not found'}), 404
@@ -195,148 +1394,75 @@ def ack_command(client_id):
 # --- API для загрузки данных от клиентов ---
 @app.route('/api/plu_upload/<client_id>', methods=['POST'])
 def api_plu_upload(client_id):
-    content = request.json
-    plu_list = content.get('plu_list', [])
-    for plu in plu_list:
-        number = plu.get('number')
-        name1 = plu.get('name1', '')
-        name2 = plu.get('name2', '')
-        price = plu.get('price')
-        code = plu.get('code', '000000')
-        group_code = plu.get('group_code', '000000')
-        tare = plu.get('tare', 0)
-        message_number = plu.get('message_number', 0)
-        expiry_type = plu.get('expiry_type', 0)
-        expiry_value = plu.get('expiry_value', '01.01.25')
-        logo_type = plu.get('logo_type', 0)
-        cert_code = plu.get('cert_code', '')
-        
-        if number and name1 and price is not None:
-            existing = PLU.query.filter_by(number=number).first()
-            if existing:
-                existing.name1 = name1
-                existing.name2 = name2
-                existing.price = price
-                existing.code = code
-                existing.group_code = group_code
-                existing.tare = tare
-                existing.message_number = message_number
-                existing.expiry_type = expiry_type
-                existing.expiry_value = expiry_value
-                existing.logo_type = logo_type
-                existing.cert_code = cert_code
-            else:
-                new_plu = PLU(
-                    number=number, name1=name1, name2=name2, price=price,
-                    code=code, group_code=group_code, tare=tare,
-                    message_number=message_number, expiry_type=expiry_type,
-                    expiry_value=expiry_value, logo_type=logo_type, cert_code=cert_code
-                )
-                db.session.add(new_plu)
+    counts = apply_plu_upload(client_id, request.json)
     db.session.commit()
-    return jsonify({'status': 'ok'})
+    return jsonify({'status': 'ok', **counts})
 
 @app.route('/api/message_upload/<client_id>', methods=['POST'])
 def api_message_upload(client_id):
-    content = request.json
-    message_list = content.get('message_list', [])
-    for msg in message_list:
-        number = msg.get('id')
-        content_text = msg.get('content', '')
-        
-        if number and content_text:
-            existing = Message.query.filter_by(number=number).first()
-            if existing:
-                existing.content = content_text
-            else:
-                new_msg = Message(number=number, content=content_text)
-                db.session.add(new_msg)
+    counts = apply_message_upload(client_id, request.json)
     db.session.commit()
-    return jsonify({'status': 'ok'})
+    return jsonify({'status': 'ok', **counts})
 
 @app.route('/api/settings_upload/<client_id>', methods=['POST'])
 def api_settings_upload(client_id):
-    content = request.json
-    settings_type = content.get('settings_type')
-    settings_data = content.get('settings_data', {})
-    
-    if settings_type == 'user':
-        existing = UserSettings.query.filter_by(client_id=client_id).first()
-        if existing:
-            existing.dept_no = settings_data.get('dept_no', 1)
-            existing.label_format = settings_data.get('label_format', 0)
-            existing.barcode_format = settings_data.get('barcode_format', 0)
-            existing.adjst = settings_data.get('adjst', 0)
-            existing.print_features = settings_data.get('print_features', 0)
-            existing.auto_print_weight = settings_data.get('auto_print_weight', 0)
-        else:
-            new_settings = UserSettings(
-                client_id=client_id,
-                dept_no=settings_data.get('dept_no', 1),
-                label_format=settings_data.get('label_format', 0),
-                barcode_format=settings_data.get('barcode_format', 0),
-                adjst=settings_data.get('adjst', 0),
-                print_features=settings_data.get('print_features', 0),
-                auto_print_weight=settings_data.get('auto_print_weight', 0)
-            )
-            db.session.add(new_settings)
-    
-    elif settings_type == 'factory':
-        existing = FactorySettings.query.filter_by(client_id=client_id).first()
-        if existing:
-            existing.max_weight = settings_data.get('max_weight', 15000)
-            existing.dec_point_weight = settings_data.get('dec_point_weight', 2)
-            existing.dec_point_price = settings_data.get('dec_point_price', 2)
-            existing.dec_point_sum = settings_data.get('dec_point_sum', 2)
-            existing.dual_range = settings_data.get('dual_range', 0)
-            existing.weight_step_upper = settings_data.get('weight_step_upper', 10)
-            existing.weight_step_lower = settings_data.get('weight_step_lower', 5)
-            existing.price_weight = settings_data.get('price_weight', 0)
-            existing.round_sum = settings_data.get('round_sum', 0)
-            existing.tare_limit = settings_data.get('tare_limit', 5000)
+    counts = apply_settings_upload(client_id, request.json)
+    db.session.commit()
+    return jsonify({'status': 'ok', **(counts or {})})
+
+@app.route('/api/batch/<client_id>', methods=['POST'])
+def api_batch(client_id):
+    """Применяет упорядоченный список элементов клиента одной транзакцией.
+
+    Элемент - словарь с полем type ('data', 'ack', 'plu_upload',
+    'message_upload', 'settings_upload') и теми же полями, что и тело
+    соответствующего отдельного запроса. Элементы с uid, уже принятые
+    раньше, пропускаются, поэтому клиент может повторять пакет.
+    """
+    if not client_exists(client_id):
+        return jsonify({'error': 'Unknown client'}), 404
+    items = request.json.get('items', [])
+    if items and all(item.get('type') == 'data' for item in items):
+        # Пакет только с данными (статус, продажи) пишет фоновый поток
+        error = _ingest(client_id, items)
+        if error:
+            return error
+        return jsonify({'status': 'ok', 'results': [{'status': 'ok'}] * len(items)})
+    uids = [item['uid'] for item in items if item.get('uid')]
+    seen = {r.uid for r in BatchReceipt.query.filter(BatchReceipt.uid.in_(uids))} if uids else set()
+    results = []
+    for item in items:
+        item_type = item.get('type')
+        uid = item.get('uid')
+        if uid in seen:
+            results.append({'status': 'duplicate'})
+            continue
+        if uid:
+            seen.add(uid)
+            db.session.add(BatchReceipt(uid=uid, client_id=client_id))
+        if item_type == 'ack':
+            results.append({'status': 'acknowledged'} if apply_command_ack(client_id, item)
+                           else {'error': 'Command not found'})
+        elif item_type in BATCH_HANDLERS:
+            counts = BATCH_HANDLERS[item_type](client_id, item)
+            results.append({'status': 'ok', **(counts or {})})
         else:
-            new_settings = FactorySettings(
-                client_id=client_id,
-                max_weight=settings_data.get('max_weight', 15000),
-                dec_point_weight=settings_data.get('dec_point_weight', 2),
-                dec_point_price=settings_data.get('dec_point_price', 2),
-                dec_point_sum=settings_data.get('dec_point_sum', 2),
-                dual_range=settings_data.get('dual_range', 0),
-                weight_step_upper=settings_data.get('weight_step_upper', 10),
-                weight_step_lower=settings_data.get('weight_step_lower', 5),
-                price_weight=settings_data.get('price_weight', 0),
-                round_sum=settings_data.get('round_sum', 0),
-                tare_limit=settings_data.get('tare_limit', 5000)
-            )
-            db.session.add(new_settings)
-    
+            results.append({'error': f'Unknown item type: {item_type}'})
+    prune_stale_rows()
     db.session.commit()
-    return jsonify({'status': 'ok'})
+    return jsonify({'status': 'ok', 'results': results})
 
 # --- Веб-интерфейс ---
+@app.template_filter('json_text')
+def json_text(value):
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
 @app.route('/')
 def index():
-    clients = Client.query.all()
-    # Получаем последние статусы весов для каждого клиента
-    for client in clients:
-        latest_status = ClientData.query.filter_by(
-            client_id=client.client_id, 
-            data_type='scales_status'
-        ).order_by(ClientData.created_at.desc()).first()
-        
-        if latest_status:
-            try:
-                status_data = json.loads(latest_status.data)
-                client.scales_connected = status_data.get('scales_connected', False)
-                client.connection_attempts = status_data.get('connection_attempts', 0)
-                client.last_status_time = latest_status.created_at
-            except:
-                client.scales_connected = False
-                client.connection_attempts = 0
-        else:
-            client.scales_connected = False
-            client.connection_attempts = 0
-    
+    flush_presence(force=True)
+    clients = db.session.query(Client, ClientState).outerjoin(
+        ClientState, ClientState.client_id == Client.client_id
+    ).order_by(Client.id).all()
     return render_template('index.html', clients=clients)
 
 @app.route('/commands/<client_id>')
@@ -354,9 +1480,10 @@ def send_command(client_id):
     if request.method == 'POST':
         command_text = request.form.get('command')
         if command_text:
-            command = Command(client_id=client_id, command=command_text)
+            command = Command(client_id=client_id, command=command_body(command_text))
             db.session.add(command)
             db.session.commit()
+            notify_client(client_id)
             flash(f'Команда "{command_text}" отправлена клиенту {client_id}', 'success')
             return redirect(url_for('commands', client_id=client_id))
         else:
@@ -374,8 +1501,10 @@ def plu_list():
 @app.route('/plu/select_client/<action>')
 def select_client_for_plu(action):
     """Страница выбора клиента для операций с товарами"""
+    flush_presence(force=True)
     clients = Client.query.all()
-    return render_template('select_client.html', clients=clients, action=action)
+    groups = ClientGroup.query.order_by(ClientGroup.name).all()
+    return render_template('select_client.html', clients=clients, groups=groups, action=action)
 
 @app.route('/plu/add', methods=['GET', 'POST'])
 def plu_add():
@@ -405,6 +1534,7 @@ def plu_add():
                 )
                 db.session.add(plu)
                 db.session.commit()
+                invalidate_plu_record(number)
                 flash('Товар добавлен', 'success')
                 return redirect(url_for('plu_list'))
         else:
@@ -415,6 +1545,7 @@ def plu_add():
 def plu_edit(plu_id):
     plu = PLU.query.get_or_404(plu_id)
     if request.method == 'POST':
+        old_number = plu.number
         plu.number = request.form.get('number', type=int)
         plu.name1 = request.form.get('name1')
         plu.name2 = request.form.get('name2', '')
@@ -429,6 +1560,7 @@ def plu_edit(plu_id):
         plu.cert_code = request.form.get('cert_code', '')
         
         db.session.commit()
+        invalidate_plu_record(old_number, plu.number)
         flash('Товар обновлен', 'success')
         return redirect(url_for('plu_list'))
     return render_template('plu_form.html', action='edit', plu=plu)
@@ -436,35 +1568,25 @@ def plu_edit(plu_id):
 @app.route('/plu/delete/<int:plu_id>', methods=['POST'])
 def plu_delete(plu_id):
     plu = PLU.query.get_or_404(plu_id)
+    number = plu.number
     db.session.delete(plu)
     db.session.commit()
+    invalidate_plu_record(number)
     flash('Товар удален', 'success')
     return redirect(url_for('plu_list'))
 
 # --- Кнопки для обмена с весами ---
 @app.route('/plu/send_to_scales/<client_id>', methods=['GET', 'POST'])
 def send_to_scales(client_id):
+    full = request.args.get('full', type=int) == 1
     plus = PLU.query.all()
-    plu_data = []
-    for p in plus:
-        plu_data.append({
-            'number': p.number,
-            'name1': p.name1,
-            'name2': p.name2,
-            'price': p.price,
-            'code': p.code,
-            'group_code': p.group_code,
-            'tare': p.tare,
-            'message_number': p.message_number,
-            'expiry_type': p.expiry_type,
-            'expiry_value': p.expiry_value,
-            'logo_type': p.logo_type,
-            'cert_code': p.cert_code
-        })
-    command = Command(client_id=client_id, command=json.dumps({'action': 'upload_plu', 'data': plu_data}))
-    db.session.add(command)
+    count = enqueue_plu_upload(client_id, plus, full=full)
     db.session.commit()
-    flash(f'Товары отправлены клиенту {client_id}', 'success')
+    notify_client(client_id)
+    if count:
+        flash(f'Отправлено товаров клиенту {client_id}: {count} из {len(plus)}', 'success')
+    else:
+        flash(f'Все товары уже загружены в весы клиента {client_id}', 'info')
     return redirect(url_for('plu_list'))
 
 @app.route('/plu/load_from_scales_form/<client_id>', methods=['GET', 'POST'])
@@ -480,9 +1602,14 @@ def load_from_scales_form(client_id):
         except Exception:
             flash('Некорректный формат номеров', 'danger')
             return redirect(url_for('load_from_scales_form', client_id=client_id))
-        command = Command(client_id=client_id, command=json.dumps({'action': 'download_plu', 'numbers': num_list}))
+        command_data = {'action': 'download_plu', 'numbers': num_list}
+        if request.form.get('refresh'):
+            # Товары могли изменить на самих весах - читаем их из весов, а не из копии клиента
+            command_data['refresh'] = True
+        command = Command(client_id=client_id, command=json.dumps(command_data))
         db.session.add(command)
         db.session.commit()
+        notify_client(client_id)
         flash(f'Команда на загрузку товаров отправлена клиенту {client_id}', 'success')
         return redirect(url_for('plu_list'))
     
@@ -533,6 +1660,91 @@ def message_delete(message_id):
     flash('Сообщение удалено', 'success')
     return redirect(url_for('message_list'))
 
+# --- Группы весов ---
+@app.route('/groups')
+def group_list():
+    groups = ClientGroup.query.order_by(ClientGroup.name).all()
+    fanouts = FanOut.query.order_by(FanOut.id.desc()).limit(20).all()
+    return render_template('groups.html', groups=groups, fanouts=fanouts)
+
+def save_group(group):
+    name = request.form.get('name', '').strip()
+    if not name:
+        flash('Укажите название группы', 'danger')
+        return False
+    other = ClientGroup.query.filter_by(name=name).first()
+    if other and other.id != group.id:
+        flash('Группа с таким названием уже существует', 'danger')
+        return False
+    group.name = name
+    selected = set(request.form.getlist('clients'))
+    group.members = [m for m in group.members if m.client_id in selected]
+    present = {m.client_id for m in group.members}
+    group.members += [ClientGroupMember(client_id=c) for c in sorted(selected - present)]
+    db.session.add(group)
+    db.session.commit()
+    return True
+
+@app.route('/groups/add', methods=['GET', 'POST'])
+def group_add():
+    group = ClientGroup()
+    if request.method == 'POST' and save_group(group):
+        flash('Группа добавлена', 'success')
+        return redirect(url_for('group_list'))
+    clients = Client.query.order_by(Client.client_id).all()
+    return render_template('group_form.html', group=None, clients=clients, members=set(), action='add')
+
+@app.route('/groups/edit/<int:group_id>', methods=['GET', 'POST'])
+def group_edit(group_id):
+    group = ClientGroup.query.get_or_404(group_id)
+    if request.method == 'POST' and save_group(group):
+        flash('Группа обновлена', 'success')
+        return redirect(url_for('group_list'))
+    clients = Client.query.order_by(Client.client_id).all()
+    members = {m.client_id for m in group.members}
+    return render_template('group_form.html', group=group, clients=clients, members=members, action='edit')
+
+@app.route('/groups/delete/<int:group_id>', methods=['POST'])
+def group_delete(group_id):
+    group = ClientGroup.query.get_or_404(group_id)
+    db.session.delete(group)
+    db.session.commit()
+    flash('Группа удалена', 'success')
+    return redirect(url_for('group_list'))
+
+@app.route('/groups/send/<int:group_id>', methods=['GET', 'POST'])
+def group_send(group_id):
+    """Отправка товаров всем весам группы: все команды ставятся одной транзакцией"""
+    group = ClientGroup.query.get_or_404(group_id)
+    numbers = request.args.get('numbers', '')
+    if numbers:
+        num_list = [int(n) for n in numbers.split(',') if n.isdigit()]
+        plus = PLU.query.filter(PLU.number.in_(num_list)).all()
+        full = True
+    else:
+        plus = PLU.query.all()
+        full = request.args.get('full', type=int) == 1
+    fanout, client_ids = start_fanout(group, plus, full=full, numbers=numbers)
+    db.session.commit()
+    for client_id in client_ids:
+        notify_client(client_id)
+    flash(f'Товары отправлены в группу {group.name}: весов {len(client_ids)} из {fanout.total}', 'success')
+    return redirect(url_for('fanout_view', fanout_id=fanout.id))
+
+@app.route('/fanouts/<int:fanout_id>')
+def fanout_view(fanout_id):
+    fanout = FanOut.query.get_or_404(fanout_id)
+    failed = db.session.query(Command.client_id).join(
+        FanOutCommand, Command.id == FanOutCommand.command_id
+    ).filter(FanOutCommand.fanout_id == fanout.id, FanOutCommand.result == 'error').all()
+    return render_template('fanout.html', fanout=fanout, progress=fanout_progress(fanout),
+                           failed=[row[0] for row in failed])
+
+@app.route('/api/fanouts/<int:fanout_id>', methods=['GET'])
+def api_fanout(fanout_id):
+    fanout = FanOut.query.get_or_404(fanout_id)
+    return jsonify(fanout_progress(fanout))
+
 # --- Веб-интерфейс для настроек ---
 @app.route('/settings/<client_id>')
 def settings_view(client_id):
@@ -596,8 +1808,62 @@ def sales_view(client_id):
 # --- Веб-интерфейс для статуса весов ---
 @app.route('/status/<client_id>')
 def status_view(client_id):
-    statuses = ScaleStatus.query.filter_by(client_id=client_id).order_by(ScaleStatus.created_at.desc()).limit(10).all()
-    return render_template('status.html', client_id=client_id, statuses=statuses)
+    minutes = min(max(request.args.get('minutes', 60, type=int), 1), 24 * 60)
+    step = min(max(request.args.get('step', 60, type=int), 1), 3600)
+    end = datetime.utcnow()
+    readings = status_range(client_id, end - timedelta(minutes=minutes), end)
+    if readings:
+        statuses = readings[:-11:-1]
+    else:
+        # История до перехода на блоки статуса
+        statuses = ScaleStatus.query.filter_by(client_id=client_id).order_by(ScaleStatus.created_at.desc()).limit(10).all()
+    buckets = downsample(readings, timedelta(seconds=step))[::-1]
+    weighings = WeighingEvent.query.filter_by(client_id=client_id).order_by(WeighingEvent.created_at.desc()).limit(20).all()
+    return render_template('status.html', client_id=client_id, statuses=statuses, buckets=buckets,
+                           weighings=weighings, minutes=minutes, step=step)
+
+def _parse_time(name, default):
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+@app.route('/api/status_series/<client_id>', methods=['GET'])
+def api_status_series(client_id):
+    """Показания статуса за период ?from=&to= (ISO, UTC); ?step=секунды - сводка по интервалам.
+
+    Серия одинаковых показаний возвращается одним элементом: time - первое,
+    until - последнее, count - их число.
+    """
+    end = _parse_time('to', datetime.utcnow())
+    start = _parse_time('from', end - timedelta(hours=1))
+    readings = status_range(client_id, start, end)
+    step = request.args.get('step', type=int)
+    if step:
+        buckets = downsample(readings, timedelta(seconds=max(step, 1)))
+        return jsonify({'buckets': [dict(b._asdict(), start=b.start.isoformat()) for b in buckets]})
+    return jsonify({'readings': [
+        {'time': r.created_at.isoformat(), 'until': r.last_at.isoformat(), 'count': r.count,
+         'status_byte': r.status_byte, 'weight': r.weight, 'price': r.price, 'sum': r.sum, 'plu_number': r.plu_number}
+        for r in readings
+    ]})
+
+@app.route('/api/weighings/<client_id>', methods=['GET'])
+def api_weighings(client_id):
+    """Взвешивания за период ?from=&to= (ISO, UTC), по умолчанию - за последние сутки"""
+    end = _parse_time('to', datetime.utcnow())
+    start = _parse_time('from', end - timedelta(days=1))
+    weighings = WeighingEvent.query.filter(
+        WeighingEvent.client_id == client_id, WeighingEvent.created_at >= start, WeighingEvent.created_at <= end
+    ).order_by(WeighingEvent.created_at)
+    return jsonify({'weighings': [
+        {'time': w.created_at.isoformat(), 'plu_number': w.plu_number, 'weight': w.weight, 'price': w.price,
+         'sum': w.sum, 'duration': w.duration}
+        for w in weighings
+    ]})
 
 # --- Команды для весов ---
 @app.route('/send_scale_command/<client_id>', methods=['GET', 'POST'])
@@ -610,6 +1876,8 @@ def send_scale_command(client_id):
             command = Command(client_id=client_id, command=json.dumps({'action': 'get_total_sales'}))
         elif action == 'reset_total_sales':
             command = Command(client_id=client_id, command=json.dumps({'action': 'reset_total_sales'}))
+        elif action == 'refresh_mirror':
+            command = Command(client_id=client_id, command=json.dumps({'action': 'refresh_mirror'}))
         elif action == 'get_user_settings':
             command = Command(client_id=client_id, command=json.dumps({'action': 'get_user_settings'}))
         elif action == 'get_factory_settings':
@@ -620,6 +1888,7 @@ def send_scale_command(client_id):
         
         db.session.add(command)
         db.session.commit()
+        notify_client(client_id)
         flash(f'Команда "{action}" отправлена клиенту {client_id}', 'success')
         return redirect(url_for('send_scale_command', client_id=client_id))
     
@@ -638,36 +1907,29 @@ def send_selected_to_scales():
 @app.route('/plu/select_client_for_selected')
 def select_client_for_selected():
     numbers = request.args.get('numbers', '')
+    flush_presence(force=True)
     clients = Client.query.all()
-    return render_template('select_client.html', clients=clients, action='send_selected', numbers=numbers)
+    groups = ClientGroup.query.order_by(ClientGroup.name).all()
+    return render_template('select_client.html', clients=clients, groups=groups, action='send_selected',
+                           numbers=numbers)
 
 @app.route('/plu/send_selected_to_scales_final/<client_id>/<numbers>')
 def send_selected_to_scales_final(client_id, numbers):
     num_list = [int(n) for n in numbers.split(',') if n.isdigit()]
     plus = PLU.query.filter(PLU.number.in_(num_list)).all()
-    plu_data = []
-    for p in plus:
-        plu_data.append({
-            'number': p.number,
-            'name1': p.name1,
-            'name2': p.name2,
-            'price': p.price,
-            'code': p.code,
-            'group_code': p.group_code,
-            'tare': p.tare,
-            'message_number': p.message_number,
-            'expiry_type': p.expiry_type,
-            'expiry_value': p.expiry_value,
-            'logo_type': p.logo_type,
-            'cert_code': p.cert_code
-        })
-    command = Command(client_id=client_id, command=json.dumps({'action': 'upload_plu', 'data': plu_data}))
-    db.session.add(command)
+    # Выбранные вручную товары отправляются всегда, даже если уже есть в весах
+    enqueue_plu_upload(client_id, plus, full=True)
     db.session.commit()
+    notify_client(client_id)
     flash(f'Выбранные товары отправлены клиенту {client_id}', 'success')
     return redirect(url_for('plu_list'))
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
-    app.run(host='0.0.0.0', port=5000) 
\ No newline at end of file
+        init_indexes()
+        init_client_state()
+        init_command_blob_refs()
+    start_compaction()
+    atexit.register(ingest.stop)
+    app.run(host='0.0.0.0', port=5000, threaded=True) 
\ No newline at end of file
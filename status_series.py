@@ -0,0 +1,181 @@
+"""Компактное хранение истории статуса весов блоками по времени.
+
+Показание статуса - байт статуса, вес, цена, сумма и номер PLU. Флаги
+(перегрузка, тара, стабильный вес...) не хранятся отдельно: они уже есть
+в байте статуса. Показания одного клиента за CHUNK_SECONDS секунд
+складываются в один блок байт. Каждая запись блока хранит:
+- разницу времени с предыдущей записью в миллисекундах (varint);
+- байт статуса;
+- разницы веса, цены, суммы и номера PLU с предыдущей записью
+  (zigzag varint).
+Показания неподвижных весов почти не меняются, поэтому запись обычно
+занимает 6-7 байт. Первая запись блока отсчитывается от начала блока и
+нулевых значений.
+
+Младший бит первого varint записи отмечает ее вид: 0 - показание, 1 -
+повтор. Одинаковые подряд показания (простаивающие весы) не пишутся
+заново: за показанием идет одна запись повтора - время последнего
+повтора от начала блока и число повторов, которая переписывается на
+месте при каждом следующем повторе. Так сохраняется точная картина:
+когда состояние началось, когда было видно последний раз и сколько раз
+пришло.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from scale_codec import STATUS_BITS
+
+CHUNK_SECONDS = 300  # Длительность одного блока
+
+_EPOCH = datetime(1970, 1, 1)
+
+_ReadingBase = namedtuple(
+    'StatusReading', 'client_id created_at status_byte weight price sum plu_number last_at count',
+    defaults=(None, 1),
+)
+
+
+class StatusReading(_ReadingBase):
+    """Показание статуса с теми же полями, что и строка ScaleStatus.
+
+    Серия одинаковых показаний - одно значение: created_at - первое,
+    last_at - последнее, count - сколько их было.
+    """
+    __slots__ = ()
+
+
+for _name, _mask in STATUS_BITS:
+    setattr(StatusReading, _name, property(lambda self, mask=_mask: bool(self.status_byte & mask)))
+
+StatusBucket = namedtuple(
+    'StatusBucket', 'start count status_byte weight_min weight_max weight_last price sum_max plu_number'
+)
+
+
+# --- Время ---
+def to_ms(at: datetime) -> int:
+    return (at - _EPOCH) // timedelta(milliseconds=1)
+
+
+def from_ms(ms: int) -> datetime:
+    return _EPOCH + timedelta(milliseconds=ms)
+
+
+def chunk_start(at: datetime) -> datetime:
+    seconds = (at - _EPOCH) // timedelta(seconds=1)
+    return _EPOCH + timedelta(seconds=seconds - seconds % CHUNK_SECONDS)
+
+
+# --- Кодирование ---
+def _put_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _put_signed(out: bytearray, value: int):
+    _put_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+
+
+def encode_readings(readings, prev_ms: int, prev=(0, 0, 0, 0)) -> bytes:
+    """Кодирует показания (мс, статус, вес, цена, сумма, PLU) для дописывания в блок.
+
+    prev_ms и prev - время и (вес, цена, сумма, PLU) последней записи блока
+    или начало блока и нули для пустого блока.
+    """
+    out = bytearray()
+    weight0, price0, sum0, plu0 = prev
+    for ms, status, weight, price, total, plu in readings:
+        # Показания приходят по времени приема; одновременные не дают отрицательной разницы
+        _put_varint(out, max(ms - prev_ms, 0) << 1)
+        out.append(status & 0xFF)
+        _put_signed(out, weight - weight0)
+        _put_signed(out, price - price0)
+        _put_signed(out, total - sum0)
+        _put_signed(out, plu - plu0)
+        prev_ms = max(ms, prev_ms)
+        weight0, price0, sum0, plu0 = weight, price, total, plu
+    return bytes(out)
+
+
+def encode_run(last_ms: int, start_ms: int, count: int) -> bytes:
+    """Запись повтора: последнее из count повторов было в last_ms"""
+    out = bytearray()
+    _put_varint(out, (max(last_ms - start_ms, 0) << 1) | 1)
+    _put_varint(out, count)
+    return bytes(out)
+
+
+def decode_readings(data: bytes, start_ms: int):
+    """Показания блока по порядку: (мс, мс последнего повтора, число показаний, статус, вес, цена, сумма, PLU)"""
+    pos = 0
+    end = len(data)
+    values = [0, 0, 0, 0]
+    ms = start_ms
+    pending = None
+
+    def varint():
+        nonlocal pos
+        result = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    while pos < end:
+        head = varint()
+        if head & 1:
+            ms = start_ms + (head >> 1)
+            count = varint()
+            if pending:
+                pending[1] = ms
+                pending[2] = count + 1
+            continue
+        if pending:
+            yield tuple(pending)
+        ms += head >> 1
+        status = data[pos]
+        pos += 1
+        for i in range(4):
+            raw = varint()
+            values[i] += (raw >> 1) ^ -(raw & 1)
+        pending = [ms, ms, 1, status, *values]
+    if pending:
+        yield tuple(pending)
+
+
+# --- Выборки ---
+def downsample(readings, step: timedelta) -> list:
+    """Сводит показания в интервалы длиной step: число показаний, вес, сумма и последние значения.
+
+    Серия повторов попадает во все интервалы, которые она покрывает; ее
+    показания считаются в интервале, где серия началась.
+    """
+    step_ms = step // timedelta(milliseconds=1)
+    buckets = []
+    current = None
+    for reading in readings:
+        ms = to_ms(reading.created_at)
+        last_ms = to_ms(reading.last_at) if reading.last_at else ms
+        count = reading.count
+        for start in range(ms - ms % step_ms, last_ms + 1, step_ms):
+            if current is None or current[0] != start:
+                if current:
+                    buckets.append(StatusBucket(from_ms(current[0]), *current[1:]))
+                current = [start, 0, 0, reading.weight, reading.weight, 0, 0, reading.sum, 0]
+            current[1] += count
+            count = 0
+            current[2] = reading.status_byte
+            current[3] = min(current[3], reading.weight)
+            current[4] = max(current[4], reading.weight)
+            current[5] = reading.weight
+            current[6] = reading.price
+            current[7] = max(current[7], reading.sum)
+            current[8] = reading.plu_number
+    if current:
+        buckets.append(StatusBucket(from_ms(current[0]), *current[1:]))
+    return buckets
@@ -0,0 +1,86 @@
+"""Выделение взвешиваний из потока статуса весов на клиенте.
+
+Клиент опрашивает статус весов раз в секунду, но на сервер уходят не сами
+показания, а законченные взвешивания: весы пусты, на них кладут товар (вес
+не стабилен), вес успокаивается и весы считают сумму, товар снимают и вес
+возвращается к нулю. Взвешивание - PLU, вес, цена и сумма последнего
+стабильного показания с ненулевой суммой, время начала и длительность.
+
+Взвешивания копятся в памяти и отправляются пачкой по WEIGHING_BATCH штук
+или через WEIGHING_FLUSH_INTERVAL секунд после первого из них.
+"""
+import threading
+import time
+from datetime import datetime
+
+WEIGHING_BATCH = 20  # Взвешиваний в одной отправке
+WEIGHING_FLUSH_INTERVAL = 60  # Наибольшая задержка отправки взвешивания (секунды)
+
+# Состояния весов
+EMPTY = 'empty'  # Вес не больше нуля
+LOADED = 'loaded'  # На весах товар, вес не стабилен или сумма нулевая
+WEIGHED = 'weighed'  # Вес стабилен, сумма посчитана
+UNKNOWN = 'unknown'  # До первого нуля: взвешивание могло начаться до запуска клиента
+
+
+class WeighingDetector:
+    def __init__(self, batch_size: int = WEIGHING_BATCH, flush_interval: float = WEIGHING_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.state = UNKNOWN
+        self._started = None
+        self._sale = None
+        self._lock = threading.Lock()
+        self._events = []
+        self._first_at = None
+
+    def feed(self, status: dict, at: datetime = None):
+        """Принимает очередное показание статуса, возвращает законченное взвешивание или None"""
+        if not status:
+            return None
+        at = at or datetime.utcnow()
+        weight = status.get('weight', 0)
+        if weight <= 0:
+            event = None
+            if self.state in (LOADED, WEIGHED) and self._sale:
+                event = dict(self._sale, at=self._started.isoformat(timespec='seconds'),
+                             duration=round((at - self._started).total_seconds(), 1))
+                self._add(event)
+            self.state = EMPTY
+            self._started = self._sale = None
+            return event
+
+        if self.state == EMPTY:
+            self._started = at
+        if self.state == UNKNOWN:
+            return None
+        bits = status.get('bits') or {}
+        if bits.get('stable_weight') and status.get('sum', 0) > 0:
+            # Покупатель может поменять товар, не снимая весы в ноль - берется последнее
+            self.state = WEIGHED
+            self._sale = {
+                'plu_number': status.get('plu_number', 0),
+                'weight': weight,
+                'price': status.get('price', 0),
+                'sum': status['sum'],
+            }
+        else:
+            self.state = LOADED
+        return None
+
+    def _add(self, event):
+        with self._lock:
+            if not self._events:
+                self._first_at = time.monotonic()
+            self._events.append(event)
+
+    def due(self) -> bool:
+        """Пора ли отправлять накопленные взвешивания"""
+        with self._lock:
+            return bool(self._events) and (len(self._events) >= self.batch_size
+                                           or time.monotonic() - self._first_at >= self.flush_interval)
+
+    def drain(self) -> list:
+        with self._lock:
+            events, self._events = self._events, []
+            return events